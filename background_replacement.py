@@ -1,38 +1,83 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import cv2
 import numpy as np
 import mediapipe as mp
-import subprocess
+import cache
+from frame_engine import process_video_frames
+
+# batch mode: rough memory of one worker process, model and interpreter plus
+# the frames held in decoder, queues, compositing buffers and encoder
+_WORKER_BASE_BYTES = 512 * 1024 ** 2
+_WORKER_FRAME_COPIES = 24
+
+_segmentation_model = None  # one model per process, shared by the takes of a batch
+
+@lru_cache(maxsize=1)
+def _clahe():
+    """ Internal function building the CLAHE object once """
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
 
 def _enhance_frame(frame):
     """ Internal function to enhance frame using CLAHE
     (Contrast Limited Adaptive Histogram Equalization)"""
     lab = cv2.cvtColor(frame, cv2.COLOR_BGR2LAB)
     l, a, b = cv2.split(lab)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    enhanced_l = clahe.apply(l)
+    enhanced_l = _clahe().apply(l)
     enhanced_lab = cv2.merge((enhanced_l, a, b))
     return cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
 
-def _generate_foreground_mask(frame, segmentation_model):
-    """ Internal function creating background mask using mediapipe """
+def _foreground_probability(frame, segmentation_model):
+    """ Internal function returning the float32 foreground probability of mediapipe """
     frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     results = segmentation_model.process(frame_rgb)
-    mask = results.segmentation_mask
+    return results.segmentation_mask.astype(np.float32, copy=False)
+
+def _generate_foreground_mask(frame, segmentation_model):
+    """ Internal function creating background mask using mediapipe """
+    mask = _foreground_probability(frame, segmentation_model)
     _, binary_mask = cv2.threshold(mask, 0.1, 255, cv2.THRESH_BINARY)
     return binary_mask.astype(np.uint8)
 
+def _upsample_mask(probability, guide, radius=4, eps=1e-3):
+    """ Internal function scaling a low resolution probability up to the size of guide
+    and binarizing it like _generate_foreground_mask.
+    Fast guided filter: the linear coefficients are fitted at mask resolution and
+    applied to the full resolution gray frame, so edges follow the frame instead of the blocky mask
+        radius : box radius in mask pixels
+        eps    : smoothing, larger values follow the guide less """
+    height, width = guide.shape[:2]
+    if probability.shape[:2] != (height, width):
+        gray = cv2.cvtColor(guide, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+        small_gray = cv2.resize(gray, (probability.shape[1], probability.shape[0]), interpolation=cv2.INTER_AREA)
+        box = (2 * radius + 1, 2 * radius + 1)
+        mean_i = cv2.boxFilter(small_gray, -1, box)
+        mean_p = cv2.boxFilter(probability, -1, box)
+        covariance = cv2.boxFilter(small_gray * probability, -1, box) - mean_i * mean_p
+        variance = cv2.boxFilter(small_gray * small_gray, -1, box) - mean_i * mean_i
+        a = covariance / (variance + eps)
+        b = mean_p - a * mean_i
+        a = cv2.resize(cv2.boxFilter(a, -1, box), (width, height), interpolation=cv2.INTER_LINEAR)
+        b = cv2.resize(cv2.boxFilter(b, -1, box), (width, height), interpolation=cv2.INTER_LINEAR)
+        probability = a * gray + b
+    _, binary_mask = cv2.threshold(probability, 0.1, 255, cv2.THRESH_BINARY)
+    return binary_mask.astype(np.uint8)
+
 def _stabilize_mask(current_mask, previous_mask, alpha=0.8):
     """ Internal function to reduce jittering by weighing previous frame with current """
     if previous_mask is None:
         return current_mask
     return cv2.addWeighted(previous_mask, alpha, current_mask, 1 - alpha, 0)
 
-def _feather_mask(mask, blur_radius=15):
+def _feather_mask(mask, blur_radius=15, buffers=None):
     """ Internal function to blur edges between foreground and background"""
-    dilated_mask = cv2.dilate(mask, None, iterations=5)
-    blurred_mask = cv2.GaussianBlur(dilated_mask, (blur_radius, blur_radius), 0)
-    return blurred_mask.astype(np.uint8)
+    buffers = {} if buffers is None else buffers
+    dilated_mask = cv2.dilate(mask, None, dst=buffers.get("dilated"), iterations=5)
+    blurred_mask = cv2.GaussianBlur(dilated_mask, (blur_radius, blur_radius), 0, dst=buffers.get("feathered"))
+    buffers["dilated"], buffers["feathered"] = dilated_mask, blurred_mask
+    return blurred_mask
 
 def _crop_background_to_input_aspect_ratio(background_frame, input_width, input_height):
     """ Internal function to cut background to portrait mode, retaining the original perspective.
@@ -53,114 +98,391 @@ def _crop_background_to_input_aspect_ratio(background_frame, input_width, input_
     return cropped_resized_background
 
 
-def _replace_background_with_feathering(frame, background_resized, mask):
-    """ Internal function to replace background with feathering"""
-    feathered_mask = _feather_mask(mask)
-    # normalize the feathered mask to create an alpha channel
-    alpha = feathered_mask / 255.0
-    # expand alpha to have the same number of channels as the frame
-    alpha = cv2.merge([alpha, alpha, alpha])  # Convert (H, W, 1) -> (H, W, 3)
-    # convert frame and background to float32 for blending
-    frame = frame.astype(np.float32)
-    background_resized = background_resized.astype(np.float32)
-    # Blend the foreground and background using the alpha mask
-    foreground = cv2.multiply(alpha, frame, dtype=cv2.CV_32F)
-    background = cv2.multiply(1 - alpha, background_resized, dtype=cv2.CV_32F)
-    blended_frame = cv2.add(foreground, background)
-    return blended_frame.astype(np.uint8)  # Convert back to uint8 for output
-
-def _add_audio(input_video_path, processed_video_path, output_path):
-    """ Internal function to retain audio """
-    command = [
-        'ffmpeg',
-        '-y',
-        '-i', processed_video_path,
-        '-i', input_video_path,
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-map', '0:v:0', # input 1: use video
-        '-map', '1:a:0', # input 2: use video
-        output_path
-    ]
-    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-
-
-def process_video_with_video_background(input_path, output_path, background_video_path):
-    temp_video_path = output_path.replace('.mp4', '_temp.mp4')
-
-    cap = cv2.VideoCapture(input_path)
+def _background_store(background_video_path, width, height, keep=()):
+    """ Internal function decoding the background once, cropped and resized to width x height,
+    into a frame store file. Every take of that size maps the same file,
+    frame i of the loop is store[i % len(store)]
+        keep : other stores in use, not evicted to make room for this one
+    returns the path of the store """
+    key = cache.cache_key(cache.file_hash(background_video_path), width, height)
+    path = cache.entry_file("backgrounds", key, ".bgr")
+    try:
+        os.utime(path)  # mark as recently used for eviction
+        return path
+    except FileNotFoundError:
+        pass  # not built yet, or evicted by a concurrent run since
     background_cap = cv2.VideoCapture(background_video_path)
-
-    if not cap.isOpened():
-        raise FileNotFoundError(f"Cannot open input video file: {input_path}")
     if not background_cap.isOpened():
         raise FileNotFoundError(f"Cannot open background video file: {background_video_path}")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    frame_count = 0
+    with open(temp_path, 'wb') as f:
+        while True:
+            ret_bg, background_frame = background_cap.read()
+            if not ret_bg:
+                break
+            f.write(_crop_background_to_input_aspect_ratio(background_frame, width, height).tobytes())
+            frame_count += 1
+    background_cap.release()
+    if frame_count == 0:
+        os.remove(temp_path)
+        raise RuntimeError(f"No frames decoded from background video: {background_video_path}")
+    os.replace(temp_path, path)
+    print(f"Background: stored {frame_count} frames at {width}x{height}")
+    cache.evict_frames(path, *keep)  # an evicted store stays readable while it is mapped
+    return path
 
-    fps = cap.get(cv2.CAP_PROP_FPS)  # Use original video's fps (no casting to int, preserve the exact fps)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    out = cv2.VideoWriter(temp_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+def _shared_segmentation_model():
+    """ Internal function loading the segmentation model once per process """
+    global _segmentation_model
+    if _segmentation_model is None:
+        _segmentation_model = mp.solutions.selfie_segmentation.SelfieSegmentation(model_selection=1)
+    return _segmentation_model
 
-    mp_selfie_segmentation = mp.solutions.selfie_segmentation
-    segmentation_model = mp_selfie_segmentation.SelfieSegmentation(model_selection=1)
 
-    previous_mask = None
-    frame_idx = 0
-    prev_time = 0
+def _replace_background_with_feathering(frame, background_resized, mask, buffers=None, blur_radius=15):
+    """ Internal function to replace background with feathering.
+    Blends in 8.8 fixed point: (frame * alpha + background * (255 - alpha)) / 255, rounded.
+    Alpha stays single channel until the blend, it is then spread into a reused uint8 buffer
+    (numpy broadcasting over the interleaved color channels is several times slower)
+        buffers : dict kept by the caller, the intermediate frames are allocated once and reused.
+                  Only the returned frame is new, it may still be queued for encoding """
+    buffers = {} if buffers is None else buffers
+    if buffers.get("shape") != frame.shape:
+        buffers.clear()
+        buffers["shape"] = frame.shape
+        buffers["alpha"] = np.empty(frame.shape, dtype=np.uint8)
+        buffers["foreground"] = np.empty(frame.shape, dtype=np.uint16)
+        buffers["background"] = np.empty(frame.shape, dtype=np.uint16)
+    alpha, foreground, background = buffers["alpha"], buffers["foreground"], buffers["background"]
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        ret_bg, background_frame = background_cap.read()
+    feathered_mask = _feather_mask(mask, blur_radius, buffers)
+    cv2.merge([feathered_mask] * frame.shape[2], dst=alpha)
+    # at most 255 * 255, so the weighted sum fits into uint16
+    np.multiply(frame, alpha, out=foreground, dtype=np.uint16)
+    np.subtract(255, alpha, out=alpha)
+    np.multiply(background_resized, alpha, out=background, dtype=np.uint16)
+    np.add(foreground, background, out=foreground)
+    # exact rounded division by 255: (x + 128 + ((x + 128) >> 8)) >> 8
+    np.add(foreground, 128, out=foreground)
+    np.right_shift(foreground, 8, out=background)
+    np.add(foreground, background, out=foreground)
+    np.right_shift(foreground, 8, out=foreground)
+    blended_frame = np.empty(frame.shape, dtype=np.uint8)
+    np.copyto(blended_frame, foreground, casting='unsafe')
+    return blended_frame
 
-        if not ret_bg:
-            background_cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Reset background video if it reaches the end
-            ret_bg, background_frame = background_cap.read()
+class _BackgroundReplacer:
+    """ Internal per-frame state of the background replacement:
+    background frame store, segmentation model and the previous mask.
+    Both are opened in open() so the replacer can be sent to a worker process first.
+    With segment_every > 1 the frames between two segmented frames are held back
+    until the next one is segmented and get a linear blend of both masks.
+    mask_track is a bit-packed (frames, height, ceil(width / 8)) file of the raw masks:
+    replay_masks reads the masks from it instead of loading the model, otherwise they are recorded into it.
+    background_store is the frame store of the take size, built in open() when missing """
+    stateful = True
+    warmup_frames = 30  # chunked rendering: 0.8 ** 30 leaves < 0.2% of a stale mask
+
+    def __init__(self, background_video_path, inference_width=None, segment_every=1, shared_model=False,
+                 mask_alpha=0.8, blur_radius=15, mask_track=None, replay_masks=False, background_store=None):
+        if not os.path.exists(background_video_path):
+            raise FileNotFoundError(f"Cannot open background video file: {background_video_path}")
+        if segment_every < 1:
+            raise ValueError(f"segment_every must be >= 1, got {segment_every}")
+        self.background_video_path = background_video_path
+        self.background_store = background_store  # built by the caller, chunk processes only map it
+        self.background_frames = None
+        self.inference_width = inference_width
+        self.segment_every = segment_every
+        self.shared_model = shared_model  # batch mode: use the model of the process, do not close it
+        self.mask_alpha, self.blur_radius = mask_alpha, blur_radius
+        self.mask_track, self.replay_masks = mask_track, replay_masks
+        # chunked rendering: held frames are released by the next segmented frame
+        self.lookahead_frames = 0 if replay_masks else segment_every
+        self.masks = None
+        self.segmentation_model = None
+        self.width, self.height = None, None
+        self.inference_size = None
+        self.buffers = {}  # compositing buffers, reused across frames
+        self.seek(0)
+
+    def open(self, width, height, fps):
+        self.width, self.height = width, height
+        if self.inference_width and self.inference_width < width:
+            self.inference_size = (self.inference_width, max(1, round(height * self.inference_width / width)))
+        if self.background_store is None:
+            self.background_store = _background_store(self.background_video_path, width, height)
+        try:
+            self.background_frames = np.memmap(self.background_store, dtype=np.uint8, mode='r')
+        except FileNotFoundError:  # evicted by a concurrent run since it was built
+            self.background_store = _background_store(self.background_video_path, width, height)
+            self.background_frames = np.memmap(self.background_store, dtype=np.uint8, mode='r')
+        self.background_frames = self.background_frames.reshape(-1, height, width, 3)
+        if self.mask_track is not None:
+            self.masks = np.memmap(self.mask_track, dtype=np.uint8, mode='r' if self.replay_masks else 'r+')
+            self.masks = self.masks.reshape(-1, height, (width + 7) // 8)
+        if self.replay_masks:
+            return  # no model needed
+        if self.shared_model:
+            self.segmentation_model = _shared_segmentation_model()
+        else:
+            mp_selfie_segmentation = mp.solutions.selfie_segmentation
+            self.segmentation_model = mp_selfie_segmentation.SelfieSegmentation(model_selection=1)
+
+    def seek(self, frame_index):
+        # keeps the background loop and the segmented frames where an unsplit render has them
+        self.frame_count = frame_index
+        self.previous_mask = None
+        self.previous_probability = None
+        self.held_frames = []
+
+    def close(self):
+        self.background_frames = None
+        if self.masks is not None and not self.replay_masks:
+            self.masks.flush()
+        self.masks = None
+        if self.segmentation_model is not None and not self.shared_model:
+            self.segmentation_model.close()
+
+    def _segment(self, frame):
+        """ Internal function running the model on an (optionally downscaled) enhanced copy """
+        if self.inference_size is not None:
+            frame = cv2.resize(frame, self.inference_size, interpolation=cv2.INTER_AREA)
+        return _foreground_probability(_enhance_frame(frame), self.segmentation_model)
 
-        # Ensure the background frame is resized correctly
-        background_resized = _crop_background_to_input_aspect_ratio(background_frame, width, height)
+    def _composite(self, frame, background_resized, current_mask):
+        """ Internal function stabilizing and applying one full resolution mask """
+        stabilized_mask = _stabilize_mask(current_mask, self.previous_mask, self.mask_alpha)
+        self.previous_mask = stabilized_mask
+        return _replace_background_with_feathering(frame, background_resized, stabilized_mask, self.buffers,
+                                                   self.blur_radius)
 
-        # Enhance the foreground frame
-        enhanced_frame = _enhance_frame(frame)
+    def _segmented_composite(self, frame, background_resized, probability, frame_index):
+        """ Internal function upsampling a mask, recording it and applying it """
+        current_mask = _upsample_mask(probability, frame)
+        if self.masks is not None and frame_index < len(self.masks):
+            self.masks[frame_index] = np.packbits(current_mask, axis=1)
+        return self._composite(frame, background_resized, current_mask)
 
-        # Generate and stabilize the foreground mask
-        current_mask = _generate_foreground_mask(enhanced_frame, segmentation_model)
-        stabilized_mask = _stabilize_mask(current_mask, previous_mask)
-        previous_mask = stabilized_mask
+    def __call__(self, frame):
+        frame_index = self.frame_count
+        self.frame_count += 1
+        # already cropped and resized, the background loops by index
+        background_resized = self.background_frames[frame_index % len(self.background_frames)]
 
-        # Replace the background with the stabilized mask
-        final_frame = _replace_background_with_feathering(frame, background_resized, stabilized_mask)
+        if self.replay_masks:
+            current_mask = np.unpackbits(self.masks[frame_index], axis=1, count=self.width)
+            return self._composite(frame, background_resized, np.multiply(current_mask, 255, out=current_mask))
 
-        # Ensure frames are written with no delay, based on the current time in the video
-        current_time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000  # Get current time in seconds
-        if current_time > prev_time:  # Only write if the time progresses (no skipped frames)
-            out.write(final_frame)
-            prev_time = current_time
+        if frame_index % self.segment_every != 0 and self.previous_probability is not None:
+            self.held_frames.append((frame, background_resized, frame_index))
+            return None
 
-        frame_idx += 1
-        if frame_idx % 100 == 0:
-            print(f"Processed frame {frame_idx}/{total_frames}")
+        probability = self._segment(frame)
+        # release the held frames with masks interpolated between the two segmented frames
+        output_frames = []
+        steps = len(self.held_frames) + 1
+        for step, (held_frame, held_background, held_index) in enumerate(self.held_frames, start=1):
+            weight = step / steps
+            blended = cv2.addWeighted(self.previous_probability, 1 - weight, probability, weight, 0)
+            output_frames.append(self._segmented_composite(held_frame, held_background, blended, held_index))
+        self.held_frames = []
+        self.previous_probability = probability
+        output_frames.append(self._segmented_composite(frame, background_resized, probability, frame_index))
+        return output_frames if len(output_frames) > 1 else output_frames[0]
 
+    def flush(self):
+        """ Frames after the last segmented one keep its mask """
+        output_frames = [self._segmented_composite(held_frame, held_background, self.previous_probability, held_index)
+                         for held_frame, held_background, held_index in self.held_frames]
+        self.held_frames = []
+        return output_frames
+
+
+def _mask_track(input_path, inference_width, segment_every):
+    """ Internal function returning (track file, frames, width, height) of the mask track of a take.
+    The raw masks only depend on the take and the segmentation settings """
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Cannot open input video file: {input_path}")
+    width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     cap.release()
-    background_cap.release()
-    out.release()
+    key = cache.cache_key(cache.file_hash(input_path), inference_width, segment_every, width, height)
+    return cache.entry_file("masks", key, ".bits"), frames, width, height
 
-    _add_audio(input_path, temp_video_path, output_path)
-    os.remove(temp_video_path)
 
+def process_video_with_video_background(input_path, output_path, background_video_path, workers=0, processes=0,
+                                        warmup_frames=None, inference_width=None, segment_every=1,
+                                        mask_alpha=0.8, blur_radius=15, reuse_masks=False):
+    """ Replace the background of input_path with background_video_path
+        workers         : > 0 overlaps decoding, segmentation and encoding in threads
+        processes       : > 1 renders chunks of the video in parallel processes
+        warmup_frames   : frames segmented before each chunk to settle the mask, None = 30
+        inference_width : width the segmentation runs at, e.g. 640 for 4K takes. None = full resolution,
+                          the mask is scaled back up along the edges of the frame
+        segment_every   : segment every k-th frame only and interpolate the masks in between
+        mask_alpha      : weight of the previous mask when stabilizing
+        blur_radius     : feathering of the mask edges, odd
+        reuse_masks     : keep the raw masks of this take in the cache (bit-packed, keyed by its content)
+                          and read them from there next time, other backgrounds or mask_alpha / blur_radius
+                          values then run without the model. Saved by renders without processes
+    returns the number of frames processed """
+    return _replace_background(input_path, output_path, background_video_path, "Background", False,
+                               workers, processes, warmup_frames, inference_width, segment_every,
+                               mask_alpha, blur_radius, reuse_masks)
 
-def process_all_videos_with_video_background(video_input_background_dir, output_dir, background_video_path):
-    """ Iterate through all videos in directory and replace background if necessary"""
+
+def _replace_background(input_path, output_path, background_video_path, label, shared_model, workers, processes,
+                        warmup_frames, inference_width, segment_every, mask_alpha, blur_radius, reuse_masks):
+    """ Internal function behind process_video_with_video_background, also runs the batch takes """
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"Cannot open input video file: {input_path}")
+    track, record_path, replay_masks = None, None, False
+    if reuse_masks:
+        track_path, total_frames, width, height = _mask_track(input_path, inference_width, segment_every)
+        try:
+            os.utime(track_path)  # mark as recently used for eviction
+            track, replay_masks = track_path, True
+        except FileNotFoundError:
+            pass  # not recorded yet, or evicted by a concurrent run since
+        if replay_masks:
+            print(f"{label}: masks read from {track_path}")
+        elif processes > 1:
+            # chunks overlap and end on held frames, their masks would not match an unsplit render
+            print(f"{label}: masks are only saved when rendering without processes")
+        elif total_frames > 0:
+            track = f"{track_path}.{os.getpid()}.tmp"
+            with open(track, 'wb') as f:
+                f.truncate(total_frames * height * ((width + 7) // 8))
+            record_path = track_path
+    # build the background store once per take, chunk processes only map it
+    background_store = _background_store(background_video_path, *_frame_size(input_path))
+    replacer = _BackgroundReplacer(background_video_path, inference_width, segment_every, shared_model,
+                                   mask_alpha, blur_radius, track, replay_masks, background_store)
+    try:
+        frame_count = process_video_frames(input_path, output_path, replacer, label=label,
+                                           workers=workers, processes=processes, warmup_frames=warmup_frames)
+    except BaseException:
+        if record_path is not None:
+            os.remove(track)
+        raise
+    if record_path is not None:
+        if frame_count == total_frames:
+            os.replace(track, record_path)
+            print(f"{label}: masks saved to {record_path}")
+            cache.evict_frames(record_path, background_store)
+        else:
+            os.remove(track)
+            print(f"{label}: masks not saved, {frame_count} frames decoded, {total_frames} expected")
+    return frame_count
+
+
+def _frame_size(video_path):
+    """ Internal function returning (width, height) of a video """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Cannot open input video file: {video_path}")
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return size
+
+
+def _batch_workers(workers, frame_bytes):
+    """ Internal function bounding the batch processes by the cores and the memory available """
+    cpus = os.cpu_count() or 1
+    workers = min(workers or cpus, cpus)
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return workers  # not reported on this platform (e.g. macOS)
+    return max(1, min(workers, available // (_WORKER_BASE_BYTES + _WORKER_FRAME_COPIES * frame_bytes)))
+
+
+def _init_batch_worker(opencv_threads):
+    """ Internal function run once in every batch process, the model is loaded by the first take needing it """
+    cv2.setNumThreads(opencv_threads)
+
+
+def _process_take(input_path, output_path, background_video_path, inference_width, segment_every, reuse_masks):
+    """ Internal function replacing the background of one take with the model of the process
+    returns (frames, seconds) """
+    start_time = time.perf_counter()
+    frame_count = _replace_background(input_path, output_path, background_video_path, os.path.basename(input_path),
+                                      True, 0, 0, None, inference_width, segment_every, 0.8, 15, reuse_masks)
+    return frame_count, time.perf_counter() - start_time
+
+
+def process_all_videos_with_video_background(video_input_background_dir, output_dir, background_video_path,
+                                             workers=1, inference_width=None, segment_every=1, reuse_masks=False):
+    """ Iterate through all videos in directory and replace background if necessary.
+    Takes are named processed_10, processed_11, ... in sorted file name order.
+        workers : takes processed at the same time in separate processes, each loads the model once.
+                  at most as many as cores and free memory allow, 0 = that many
+        inference_width, segment_every, reuse_masks : see process_video_with_video_background
+    returns {input video: output video}, failing takes are reported and left out """
     os.makedirs(output_dir, exist_ok=True)
-    video_files = [f for f in os.listdir(video_input_background_dir) if f.endswith(('.mp4', '.mov'))]
+    video_files = sorted(f for f in os.listdir(video_input_background_dir) if f.endswith(('.mp4', '.mov')))
+    if not video_files:
+        print("Error: No video files found in the folder.")
+        return {}
+    takes = []
+    sizes = set()
     for idx, video_file in enumerate(video_files, start=10):
         input_path = os.path.join(video_input_background_dir, video_file)
         output_path = os.path.join(output_dir, f"processed_{idx}.mp4")
-        process_video_with_video_background(input_path, output_path, background_video_path)
+        try:
+            sizes.add(_frame_size(input_path))
+        except FileNotFoundError as e:
+            print(f"Error: skipping take {input_path}: {e}")
+            continue
+        takes.append((input_path, output_path))
+
+    # decode the background once per take size before the workers map it
+    stores = []
+    for width, height in sizes:
+        stores.append(_background_store(background_video_path, width, height, keep=stores))
+    frame_bytes = max([width * height * 3 for width, height in sizes] + [0])
+    workers = max(1, min(_batch_workers(workers, frame_bytes), len(takes)))
+    print(f"Background: {len(takes)} takes with {workers} processes")
+
+    start_time = time.perf_counter()
+    results = {}
+    total_frames = 0
+    if workers == 1:
+        jobs = [(input_path, None) for input_path, _ in takes]
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                   initargs=(max(1, (os.cpu_count() or 1) // workers),))
+        jobs = [(input_path, pool.submit(_process_take, input_path, output_path, background_video_path,
+                                         inference_width, segment_every, reuse_masks))
+                for input_path, output_path in takes]
+    try:
+        # collect in take order, one failing take does not stop the others
+        for (input_path, future), (_, output_path) in zip(jobs, takes):
+            try:
+                if future is None:
+                    frame_count, seconds = _process_take(input_path, output_path, background_video_path,
+                                                         inference_width, segment_every, reuse_masks)
+                else:
+                    frame_count, seconds = future.result()
+            except Exception as e:
+                print(f"Error: skipping take {input_path}: {e}")
+                continue
+            results[input_path] = output_path
+            total_frames += frame_count
+            print(f"Background: {os.path.basename(input_path)} -> {output_path}, "
+                  f"{frame_count / max(seconds, 1e-9):.1f} fps")
+    finally:
+        if workers > 1:
+            pool.shutdown(cancel_futures=True)
 
+    elapsed = time.perf_counter() - start_time
+    print(f"Background: {len(results)} / {len(takes)} takes, {total_frames} frames in {elapsed:.1f} s "
+          f"({total_frames / max(elapsed, 1e-9):.1f} fps)")
+    return results
 
 
 #if __name__ == "__main__":
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import cache
+import video_cutting
+import color_grading
+import lyrics_simplified
+from video_cutting import extract_beats_from_song, cut_videos_by_song_beats, concatenate_clips_randomly
+from color_grading import apply_teal_orange
+from effects import rgb_trail
+from lyrics_simplified import sync_lyrics_manually, sync_lyrics_grid_to_video
+
+
+STAGES = ["extract_beats_from_song", "_align_song_to_video", "cut_videos_by_song_beats",
+          "concatenate_clips_randomly", "apply_teal_orange", "rgb_trail",
+          "sync_lyrics_manually", "sync_lyrics_grid_to_video"]
+
+
+def _ffmpeg(*args):
+    """ Internal function running ffmpeg quietly, overwriting the output """
+    subprocess.run(['ffmpeg', *args, '-loglevel', 'error', '-y'], check=True)
+
+
+def _make_song(song_file, duration, bpm, sr=44100):
+    """ Internal function writing a click track: a decaying 1 kHz click on every beat, hi-hat like
+    5 kHz hits on a pseudo-random pattern of sixteenths, a slow sweep and seeded noise.
+    The beats stay on the bpm grid but the song never repeats itself, so takes can be aligned unambiguously """
+    beat = 60 / bpm
+    sixteenth = beat / 4
+    clicks = (f"0.8*sin(2*PI*1000*t)*exp(-40*mod(t\\,{beat}))"
+              f"+0.8*gt(mod(abs(43758.5453*sin(12.9898*floor(t/{sixteenth})))\\,1)\\,0.6)"
+              f"*sin(2*PI*5000*t)*exp(-80*mod(t\\,{sixteenth}))"
+              f"+0.1*sin(2*PI*(110+3*t)*t)")
+    _ffmpeg('-f', 'lavfi', '-i', f"aevalsrc={clicks}:s={sr}:d={duration}",
+            '-f', 'lavfi', '-i', f"anoisesrc=d={duration}:a=0.05:r={sr}:seed=1",
+            '-filter_complex', "[0][1]amix=inputs=2:normalize=0,pan=stereo|c0=c0|c1=c0",
+            song_file)
+
+
+def _make_take(take_file, song_file, duration, offset, resolution, fps, sr=44100):
+    """ Internal function writing a testsrc take whose audio is the whole song starting offset seconds in """
+    _ffmpeg('-f', 'lavfi', '-i', f"testsrc2=size={resolution}:rate={fps}:duration={offset + duration}",
+            '-i', song_file,
+            '-af', f"adelay={round(offset * sr)}S:all=1",
+            '-map', '0:v', '-map', '1:a',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+            take_file)
+
+
+def _take_offsets(takes, sr=44100):
+    """ Internal function: known offset of the song in every take, in seconds.
+    Whole samples at the rate of the takes, anywhere between two analysis hops,
+    like a real take and not lined up with the onset envelope frames """
+    return [round((0.5 + 3.7137 * index) * sr) / sr for index in range(takes)]
+
+
+def make_media(work_dir, resolution, duration, bpm=120, fps=30, takes=3):
+    """ Generate the synthetic inputs of one configuration with ffmpeg lavfi, reused if they exist.
+    returns {"song": file, "take_dir": folder, "takes": [files], "offsets": [seconds]} """
+    media_dir = os.path.join(work_dir, f"media_{duration:g}s_{bpm:g}bpm")
+    take_dir = os.path.join(media_dir, f"takes_{resolution}_{fps}fps")
+    os.makedirs(take_dir, exist_ok=True)
+    song_file = os.path.join(media_dir, "song.wav")
+    if not os.path.exists(song_file):
+        _make_song(song_file, duration, bpm)
+    take_files = []
+    for index, offset in enumerate(_take_offsets(takes)):
+        take_file = os.path.join(take_dir, f"take{index + 1}.mp4")
+        if not os.path.exists(take_file):
+            _make_take(take_file, song_file, duration, offset, resolution, fps)
+        take_files.append(take_file)
+    return {"song": song_file, "take_dir": take_dir, "takes": take_files, "offsets": _take_offsets(takes)}
+
+
+def _cold_cache(work_dir):
+    """ Internal function starting a stage with an empty cache, no decoded audio and no colour table in memory """
+    cache.CACHE_DIR = os.path.join(work_dir, "cache")
+    shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+    video_cutting._decode_song.cache_clear()
+    color_grading._teal_orange_lut.cache_clear()
+    lyrics_simplified._glyph.cache_clear()
+
+
+def _run_stage(results, work_dir, stage, params, function, repeat, frames=None):
+    """ Internal function timing function repeat times from a cold cache and appending the result.
+    A failing stage is recorded with its error and does not stop the others.
+    returns the value of the last run or None """
+    record = {"stage": stage, **params}
+    times = []
+    value = None
+    try:
+        for _ in range(repeat):
+            _cold_cache(work_dir)
+            start_time = time.perf_counter()
+            value = function()
+            times.append(time.perf_counter() - start_time)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        print(f"Benchmark: {stage} {params} failed: {record['error']}")
+        results.append(record)
+        return None
+    record["seconds"] = min(times)
+    record["runs"] = times
+    if frames:
+        record["frames"] = frames
+        record["fps"] = frames / max(record["seconds"], 1e-9)
+    print(f"Benchmark: {stage} {params} {record['seconds']:.2f} s")
+    results.append(record)
+    return value
+
+
+def _lyrics(duration, seconds_per_line=2.0):
+    """ Internal function returning synthetic lyrics, one line every seconds_per_line """
+    count = int(duration // seconds_per_line)
+    return [(index * seconds_per_line, (index + 1) * seconds_per_line, f"line {index + 1} of the song")
+            for index in range(count)]
+
+
+def run_benchmarks(resolutions=("640x360", "1280x720"), durations=(10, 30), stages=None, repeat=1, bpm=120,
+                   fps=30, takes=3, work_dir=None, font='Futura'):
+    """ Time the pipeline stages on synthetic media for every resolution and duration.
+    Every stage starts from an empty cache, the fastest of repeat runs is reported.
+        stages   : names from STAGES, None = all
+        work_dir : keeps the generated media for the next run, None = temporary directory
+        font     : font of sync_lyrics_grid_to_video
+    returns {"environment": ..., "config": ..., "results": [{"stage", "resolution", "duration", "seconds", ...}]} """
+    stages = list(STAGES if stages is None else stages)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}")
+    temp_dir = None
+    if work_dir is None:
+        temp_dir = tempfile.mkdtemp(prefix="benchmark_")
+        work_dir = temp_dir
+    cache_dir = cache.CACHE_DIR
+    results = []
+    try:
+        # compile librosa's numba kernels before anything is timed
+        _cold_cache(work_dir)
+        extract_beats_from_song(make_media(work_dir, resolutions[0], durations[0], bpm, fps, takes)["song"])
+        for duration in durations:
+            for resolution_index, resolution in enumerate(resolutions):
+                media = make_media(work_dir, resolution, duration, bpm, fps, takes)
+                output_dir = os.path.join(work_dir, f"output_{resolution}_{duration:g}s")
+                shutil.rmtree(output_dir, ignore_errors=True)
+                os.makedirs(output_dir)
+                params = {"resolution": resolution, "duration": duration}
+                audio_params = {"resolution": None, "duration": duration}
+                frames = int((media["offsets"][0] + duration) * fps)  # the take timed by the frame stages
+
+                # audio stages do not depend on the resolution, time them once per duration
+                if resolution_index == 0 and "extract_beats_from_song" in stages:
+                    _run_stage(results, work_dir, "extract_beats_from_song", audio_params,
+                               lambda: extract_beats_from_song(media["song"]), repeat)
+                if resolution_index == 0 and "_align_song_to_video" in stages:
+                    _cold_cache(work_dir)
+                    song, sr = video_cutting._song_audio(media["song"])
+                    video = video_cutting._take_audio(media["takes"][-1], sr)
+                    offset = _run_stage(results, work_dir, "_align_song_to_video", audio_params,
+                                        lambda: video_cutting._align_song_to_video(song, video, sr), repeat)
+                    if offset is not None:
+                        record = results[-1]
+                        record["expected_offset"] = media["offsets"][-1]
+                        record["offset"] = offset
+                        # the timed take and every other one, more than one sample at the analysis rate off
+                        # is a wrong alignment, not noise
+                        offsets = [video_cutting._align_song_to_video(song, video_cutting._take_audio(take, sr), sr)
+                                   for take in media["takes"][:-1]] + [offset]
+                        wrong = [f"offset {found:.5f} s, expected {expected:.5f} s"
+                                 for found, expected in zip(offsets, media["offsets"])
+                                 if abs(found - expected) * sr > 1]
+                        if wrong:
+                            record["error"] = "; ".join(wrong)
+                            print(f"Benchmark: _align_song_to_video {audio_params} failed: {record['error']}")
+
+                if "cut_videos_by_song_beats" in stages or "concatenate_clips_randomly" in stages:
+                    beat_sequence = extract_beats_from_song(media["song"])
+                    clips_dir = os.path.join(output_dir, "clips")
+
+                    def cut():
+                        shutil.rmtree(clips_dir, ignore_errors=True)  # per beat cutting does not overwrite
+                        return cut_videos_by_song_beats(media["take_dir"], beat_sequence, media["song"], clips_dir)
+
+                    if "cut_videos_by_song_beats" in stages:
+                        # includes aligning every take, the offsets are not cached between runs
+                        clips_by_beat = _run_stage(results, work_dir, "cut_videos_by_song_beats",
+                                                   {**params, "takes": takes}, cut, repeat)
+                    else:
+                        try:
+                            clips_by_beat = cut()  # concatenate only, clips are cut untimed
+                        except Exception as e:
+                            clips_by_beat = None
+                            print(f"Benchmark: cutting clips for concatenate_clips_randomly {params} failed: {e}")
+
+                    def concatenate():
+                        random.seed(0)
+                        output_file = os.path.join(output_dir, "concatenated.mp4")
+                        if os.path.exists(output_file):
+                            os.remove(output_file)  # the concat step does not overwrite
+                        concatenate_clips_randomly(clips_by_beat, beat_sequence, output_file, media["song"])
+
+                    if clips_by_beat is not None and "concatenate_clips_randomly" in stages:
+                        _run_stage(results, work_dir, "concatenate_clips_randomly", params, concatenate, repeat)
+
+                take = media["takes"][0]
+                # every method, the lut one including building its table
+                for method in ("opencv", "lut", "lut3d"):
+                    if "apply_teal_orange" in stages:
+                        _run_stage(results, work_dir, "apply_teal_orange", {**params, "method": method},
+                                   lambda: apply_teal_orange(take,
+                                                             os.path.join(output_dir, f"teal_orange_{method}.mp4"),
+                                                             method=method),
+                                   repeat, frames)
+                if "rgb_trail" in stages:
+                    _run_stage(results, work_dir, "rgb_trail", params,
+                               lambda: rgb_trail(take, os.path.join(output_dir, "rgb_trail.mp4"), seed=0),
+                               repeat, frames)
+                lyrics = _lyrics(duration)
+                for backend in ("ffmpeg", "moviepy"):
+                    if "sync_lyrics_manually" in stages:
+                        _run_stage(results, work_dir, "sync_lyrics_manually", {**params, "backend": backend},
+                                   lambda: sync_lyrics_manually(lyrics, take,
+                                                                os.path.join(output_dir, f"lyrics_{backend}.mp4"),
+                                                                backend=backend),
+                                   repeat, frames)
+                    if "sync_lyrics_grid_to_video" in stages:
+                        _run_stage(results, work_dir, "sync_lyrics_grid_to_video", {**params, "backend": backend},
+                                   lambda: sync_lyrics_grid_to_video(lyrics, take,
+                                                                     os.path.join(output_dir, f"grid_{backend}.mp4"),
+                                                                     font=font, backend=backend),
+                                   repeat, frames)
+    finally:
+        cache.CACHE_DIR = cache_dir
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {
+        "environment": _environment(),
+        "config": {"resolutions": list(resolutions), "durations": list(durations), "stages": stages,
+                   "repeat": repeat, "bpm": bpm, "fps": fps, "takes": takes, "font": font},
+        "results": results,
+    }
+
+
+def _environment():
+    """ Internal function describing the machine and the tools a run was measured with """
+    try:
+        ffmpeg_version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+    except OSError:
+        ffmpeg_version = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg_version,
+    }
+
+
+def _result_key(record):
+    """ Internal function identifying a result across runs """
+    return tuple((name, record[name]) for name in ("stage", "resolution", "duration", "backend", "method", "takes")
+                 if name in record)
+
+
+def compare(previous, current):
+    """ Print the speedup of every stage measured in both runs (> 1 = current is faster) """
+    previous_seconds = {_result_key(record): record["seconds"] for record in previous["results"] if "seconds" in record}
+    for record in current["results"]:
+        key = _result_key(record)
+        if key not in previous_seconds or "seconds" not in record:
+            continue
+        label = ' '.join(str(value) for _, value in key if value is not None)
+        print(f"{label}: {previous_seconds[key]:.2f} s -> {record['seconds']:.2f} s "
+              f"({previous_seconds[key] / max(record['seconds'], 1e-9):.2f}x)")
+
+
+if __name__ == '__main__':
+    # python benchmark.py --resolutions 640x360 1920x1080 --durations 10 60 --output benchmark.json
+    # python benchmark.py --stages rgb_trail apply_teal_orange --compare benchmark.json
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic media")
+    parser.add_argument("--resolutions", nargs="+", default=["640x360", "1280x720"])
+    parser.add_argument("--durations", nargs="+", type=float, default=[10, 30])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=None)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--bpm", type=float, default=120)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--takes", type=int, default=3)
+    parser.add_argument("--font", default='Futura')
+    parser.add_argument("--work-dir", default=None, help="keep the generated media here for the next run")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.resolutions, args.durations, args.stages, args.repeat, args.bpm, args.fps,
+                            args.takes, os.path.abspath(args.work_dir) if args.work_dir else None, args.font)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    sys.exit(1 if any("error" in record for record in report["results"]) else 0)
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import threading
+
+
+CACHE_DIR = os.environ.get("VIDEO_CACHE_DIR", ".cache")
+MAX_CACHE_BYTES = int(os.environ.get("VIDEO_CACHE_MAX_BYTES", 4 * 1024 ** 3))  # 4 GB
+# memory-mapped frame stores, a single one can outgrow every other entry together
+MAX_FRAME_BYTES = int(os.environ.get("VIDEO_CACHE_MAX_FRAME_BYTES", 16 * 1024 ** 3))  # 16 GB
+FRAME_NAMESPACES = ("backgrounds", "masks")
+
+_lock = threading.Lock()
+
+
+def _entry_path(namespace, key, extension=".pkl"):
+    """ Internal function mapping an entry to its file inside the cache directory """
+    return os.path.join(CACHE_DIR, namespace, f"{key}{extension}")
+
+
+def file_hash(path):
+    """ Content hash of a file. Hashes are remembered per (path, size, mtime)
+    so unchanged media is only read once """
+    stat = os.stat(path)
+    index_file = os.path.join(CACHE_DIR, "file_hashes.json")
+    signature = [stat.st_size, stat.st_mtime_ns]
+    abs_path = os.path.abspath(path)
+    with _lock:
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        if abs_path in index and index[abs_path][:2] == signature:
+            return index[abs_path][2]
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+
+    with _lock:
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index[abs_path] = signature + [content_hash]
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_file, index_file)
+    return content_hash
+
+
+def cache_key(*parts):
+    """ Key built from file hashes and the parameters that influence a result """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=20).hexdigest()
+
+
+def load(namespace, key):
+    """ Return the cached value or None """
+    path = _entry_path(namespace, key)
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    try:
+        os.utime(path)  # mark as recently used for eviction
+    except OSError:
+        pass  # evicted by another thread after reading, the value is still valid
+    return value
+
+
+def store(namespace, key, value):
+    """ Write value to the cache and evict the least recently used entries
+    once the cache grows beyond MAX_CACHE_BYTES """
+    path = _entry_path(namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+    evict(keep=(path,))
+    return value
+
+
+def entry_file(namespace, key, extension):
+    """ Path of an entry the caller writes itself, e.g. a memory-mapped array.
+    Write to a .tmp file next to it and os.replace it, the entry then counts
+    towards MAX_CACHE_BYTES like a stored value, or towards MAX_FRAME_BYTES
+    in FRAME_NAMESPACES """
+    path = _entry_path(namespace, key, extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _entries():
+    """ Internal function listing (last use, size, path) of every cache entry """
+    entries = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+    for namespace in os.listdir(CACHE_DIR):
+        namespace_dir = os.path.join(CACHE_DIR, namespace)
+        if not os.path.isdir(namespace_dir):
+            continue
+        for name in os.listdir(namespace_dir):
+            if name.endswith('.tmp'):
+                continue  # still being written
+            try:
+                stat = os.stat(os.path.join(namespace_dir, name))
+            except OSError:
+                continue  # removed by a concurrent run
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(namespace_dir, name)))
+    return entries
+
+
+def _namespace(path):
+    """ Internal function returning the namespace of an entry """
+    return os.path.basename(os.path.dirname(path))
+
+
+def evict(max_bytes=None, namespaces=None, keep=()):
+    """ Remove least recently used entries until the cache fits into max_bytes
+        namespaces : namespaces counted and evicted, None = all but FRAME_NAMESPACES
+        keep       : entries never removed, e.g. the one just written """
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    keep = {os.path.abspath(path) for path in keep}
+    with _lock:
+        if namespaces is None:
+            entries = [entry for entry in _entries() if _namespace(entry[2]) not in FRAME_NAMESPACES]
+        else:
+            entries = [entry for entry in _entries() if _namespace(entry[2]) in namespaces]
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def evict_frames(*keep):
+    """ Remove least recently used frame stores until they fit into MAX_FRAME_BYTES
+        keep : stores never removed, e.g. the one just written or mapped by this run """
+    evict(MAX_FRAME_BYTES, FRAME_NAMESPACES, keep)
+
+
+def invalidate(namespace=None):
+    """ Remove every entry, or only the entries of one namespace
+    (beats, offsets, audio, clips, backgrounds, masks, transcripts, vocals) """
+    with _lock:
+        for _, _, path in _entries():
+            if namespace is None or _namespace(path) == namespace:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    print(f"Cache invalidated: {namespace or 'all entries'}")
+
+
+if __name__ == '__main__':
+    # python cache.py invalidate [namespace]
+    # python cache.py info
+    if len(sys.argv) >= 2 and sys.argv[1] == "invalidate":
+        invalidate(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "info":
+        entries = _entries()
+        print(f"{len(entries)} entries, {sum(size for _, size, _ in entries) / 1024 ** 2:.1f} MB in {CACHE_DIR}")
+    else:
+        print("usage: python cache.py invalidate [namespace] | info")
@@ -1,7 +1,13 @@
 import cv2
 import numpy as np
 import subprocess
+import functools
 import os
+import tempfile
+import threading
+from frame_engine import process_video_frames
+
+_lut_lock = threading.Lock()
 
 
 def _teal_orange(frame, intensity=0.8):
@@ -17,20 +23,61 @@ def _teal_orange(frame, intensity=0.8):
 
     return cv2.cvtColor(graded_lab, cv2.COLOR_LAB2BGR)
 
-def _add_audio(input_video_path, processed_video_path, output_path):
-    """ Internal function to retain audio """
-    command = [
-        'ffmpeg',
-        '-y',
-        '-i', processed_video_path,
-        '-i', input_video_path,
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-map', '0:v:0', # input 1: use video
-        '-map', '1:a:0', # input 2: use video
-        output_path
-    ]
-    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+@functools.lru_cache(maxsize=4)
+def _teal_orange_lut(intensity):
+    """ Internal function grading all 2**24 colours once with _teal_orange.
+    returns a flat uint32 table of packed B, G, R, 0 bytes indexed by b << 16 | g << 8 | r """
+    codes = np.arange(1 << 24, dtype=np.uint32)
+    palette = np.empty((4096, 4096, 3), dtype=np.uint8)  # every colour exactly once
+    flat_palette = palette.reshape(-1, 3)
+    flat_palette[:, 0] = codes >> 16
+    flat_palette[:, 1] = (codes >> 8) & 0xFF
+    flat_palette[:, 2] = codes & 0xFF
+    graded = _teal_orange(palette, intensity).reshape(-1, 3)
+
+    lut = np.zeros((1 << 24, 4), dtype=np.uint8)
+    lut[:, :3] = graded
+    return lut.view(np.uint32).ravel()
+
+
+def _apply_lut(frame, lut):
+    """ Internal function looking every pixel up in a table from _teal_orange_lut """
+    height, width = frame.shape[:2]
+    index = np.left_shift(frame[..., 0], 16, dtype=np.uint32)
+    index |= np.left_shift(frame[..., 1], 8, dtype=np.uint32)
+    index |= frame[..., 2]
+    packed = np.take(lut, index, out=index)  # lookup in place, no extra frame buffer
+    return cv2.cvtColor(packed.view(np.uint8).reshape(height, width, 4), cv2.COLOR_BGRA2BGR)
+
+
+def _teal_orange_fast(frame, intensity=0.8):
+    """ Internal function, same result as _teal_orange through a precomputed colour table.
+    The lock keeps pipelined workers from all building the table on the first frames """
+    with _lut_lock:
+        lut = _teal_orange_lut(intensity)
+    return _apply_lut(frame, lut)
+
+
+def export_teal_orange_cube(cube_file, intensity=0.8, size=65):
+    """ Function to write the Hollywood filter as .cube 3D LUT for ffmpeg lut3d or editing software
+        size : grid points per channel, at 65 the interpolation error averages below one level """
+    levels = np.round(np.linspace(0, 255, size)).astype(np.uint8)
+    # .cube order: red changes fastest, then green, then blue
+    blue, green, red = np.meshgrid(levels, levels, levels, indexing='ij')
+    grid = np.stack((blue.ravel(), green.ravel(), red.ravel()), axis=-1).reshape(1, -1, 3)
+    graded = _teal_orange(grid, intensity).reshape(-1, 3)
+    with open(cube_file, 'w') as f:
+        f.write(f'TITLE "teal orange {intensity}"\n')
+        f.write(f'LUT_3D_SIZE {size}\n')
+        for b, g, r in graded / 255.0:
+            f.write(f"{r:.6f} {g:.6f} {b:.6f}\n")
+    return cube_file
+
+
+def _black_white(frame):
+    """ Internal function turning a frame grey while keeping 3 channels """
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.cvtColor(grey, cv2.COLOR_GRAY2BGR)
 
 def adjust_exposure(video_input, video_output, brightness=-0.05, contrast=1.05, gamma=0.95):
     """ Function to adjust brightness and contrast
@@ -51,95 +98,61 @@ def adjust_exposure(video_input, video_output, brightness=-0.05, contrast=1.05,
 
 
 
-def apply_teal_orange(video_input_color, video_output_color, intensity=0.8):
-    """ Function to apply Hollywood filter """
-    cap = cv2.VideoCapture(video_input_color)
-    if not cap.isOpened():
-        raise ValueError("T/O: Input video cannot be opened")
-
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)  # Don't cast to int, keep the exact fps
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-
-    temp_video = 'temp_video.mp4'
-    out = cv2.VideoWriter(temp_video, fourcc, fps, (frame_width, frame_height))
-    if not out.isOpened():
-        raise ValueError(f"T/O: Output video cannot be created: {temp_video}")
-
-    frame_count = 0
-    prev_time = 0
-    prev_frame_position = 0
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        current_time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000  # Get current time in seconds
-
-        if current_time > prev_time:
-            processed_frame = _teal_orange(frame, intensity)
-            out.write(processed_frame)
-            prev_time = current_time
-
-        #current_position = cap.get(cv2.CAP_PROP_POS_FRAMES)
-        #if current_position != prev_frame_position:
-            #print(f"Writing frame {frame_count} at timestamp {current_time:.4f}")
-        #prev_frame_position = current_position
-
-        frame_count += 1
-        if frame_count % 100 == 0 or frame_count == total_frames:
-            print(f"T/O: Processed {frame_count} / {total_frames} frames")
-
-    cap.release()
-    out.release()
-
-    print(f"Final video saved to {video_output_color}")
-    _add_audio(video_input_color, temp_video, video_output_color)
-
-    if os.path.exists(temp_video):
-        os.remove(temp_video)
-
-
-
-
-
-def apply_black_white(video_input_color, video_output_color):
-    """ Function to turn video B/W while retaining audio and format"""
-    cap = cv2.VideoCapture(video_input_color)
-    if not cap.isOpened():
-        raise ValueError("B/W: Input video cannot be opened")
-
-    # get input video properties to ensure consistency in output!
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-
-    temp_video = 'temp_video.mp4'
-    out = cv2.VideoWriter(temp_video, fourcc, fps, (frame_width, frame_height))
-    if not out.isOpened():
-        raise ValueError(f"B/W: Output video cannot be created: {temp_video}")
-    frame_count = 0
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        processed_frame = cv2.cvtColor(grey, cv2.COLOR_GRAY2BGR)
-        out.write(processed_frame)
-
-        frame_count += 1
-        if frame_count % 100 == 0 or frame_count == total_frames:
-            print(f"B/W: Processed {frame_count} / {total_frames} frames")
-
-    cap.release()
-    out.release()
-    _add_audio(video_input_color, temp_video, video_output_color)
-    if os.path.exists(temp_video):
-        os.remove(temp_video)
\ No newline at end of file
+def _apply_cube(video_input, video_output, cube_file):
+    """ Internal function grading a whole video inside ffmpeg with a .cube file """
+    command = [
+        'ffmpeg',
+        '-y',
+        '-i', video_input,
+        '-vf', f'lut3d=file={cube_file}:interp=tetrahedral',
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        '-loglevel', 'error',
+        video_output
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"T/O: FFmpeg failed: {result.stderr.decode('utf-8')}")
+    print(f"Final video saved to {video_output}")
+
+
+def apply_teal_orange(video_input_color, video_output_color, intensity=0.8, method="opencv", workers=0, processes=0):
+    """ Function to apply Hollywood filter
+        method : opencv (LAB conversion per frame),
+                 lut (precomputed colour table, identical result, only faster on smooth frames,
+                 see the apply_teal_orange stage of benchmark.py),
+                 lut3d (.cube applied by ffmpeg, no python per frame, interpolated: a few levels off near clipped colours)
+        workers : lut/opencv only, number of grading threads, 0 = no pipelining
+        processes : lut/opencv only, > 1 grades chunks of the video in parallel processes """
+    if method == "lut3d":
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cube_file = export_teal_orange_cube(os.path.join(temp_dir, "teal_orange.cube"), intensity)
+            _apply_cube(video_input_color, video_output_color, cube_file)
+        return
+    if method not in ("lut", "opencv"):
+        raise ValueError(f"T/O: Unknown method: {method}")
+    grade = _teal_orange_fast if method == "lut" else _teal_orange
+    process_video_frames(video_input_color, video_output_color,
+                         functools.partial(grade, intensity=intensity), label="T/O", workers=workers,
+                         processes=processes)
+
+
+def apply_black_white(video_input_color, video_output_color, workers=0):
+    """ Function to turn video B/W while retaining audio and format
+        workers : number of processing threads, 0 = no pipelining """
+    process_video_frames(video_input_color, video_output_color, _black_white, label="B/W", workers=workers)
+
+
+def teal_orange_effect(intensity=0.8, method="opencv"):
+    """ Per-frame Hollywood filter for apply_effect_chain
+        method : opencv or lut, see apply_teal_orange """
+    if method not in ("lut", "opencv"):
+        raise ValueError(f"T/O: Unknown method: {method}")
+    return functools.partial(_teal_orange_fast if method == "lut" else _teal_orange, intensity=intensity)
+
+
+def black_white_effect():
+    """ Per-frame B/W filter for apply_effect_chain """
+    return _black_white
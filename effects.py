@@ -1,84 +1,118 @@
 import cv2
 import numpy as np
-from color_grading import _add_audio
-from collections import deque
-import os
+from frame_engine import process_video_frames
 import random
 import subprocess
 
 
-def rgb_trail(video_input_path, video_output_path, red_lag=0, green_lag=5, blue_lag=10):
-    """ Applies a lag to RGB Channels.
-        lag unit    : fps
-        trigger     : % chance
-        duration    : [1, 3] seconds """
-    cap = cv2.VideoCapture(video_input_path)
-    if not cap.isOpened():
-        raise ValueError("rgb trail: Input video can't be opened")
-
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)  # Do not cast to int to preserve exact FPS
-    total_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-
-    temp_video = 'temp_video.mp4'
-    out = cv2.VideoWriter(temp_video, fourcc, fps, (frame_width, frame_height))
-    if not out.isOpened():
-        raise ValueError("rgb trail: Output video can't be created")
-
-    red_queue = deque(maxlen=max(red_lag, green_lag, blue_lag) + 1)
-    green_queue = deque(maxlen=max(red_lag, green_lag, blue_lag) + 1)
-    blue_queue = deque(maxlen=max(red_lag, green_lag, blue_lag) + 1)
-
-    frame_count = 0
-    prev_time = 0
-    effect_active = False
-    effect_end_frame = 0
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        b, g, r = cv2.split(frame)
-
-        red_queue.append(r)
-        green_queue.append(g)
-        blue_queue.append(b)
-
-        # Handle effect activation with a random chance
-        if not effect_active and random.random() < 0.01:  # 1% chance per frame
-            effect_active = True
-            effect_duration = random.randint(int(fps * 1), int(fps * 3))  # Duration between 1 to 3 seconds
-            effect_end_frame = frame_count + effect_duration
-        if effect_active and frame_count >= effect_end_frame:
-            effect_active = False
-
-        if effect_active:
-            r_lagged = red_queue[-red_lag - 1] if red_lag < len(red_queue) else r
-            g_lagged = green_queue[-green_lag - 1] if green_lag < len(green_queue) else g
-            b_lagged = blue_queue[-blue_lag - 1] if blue_lag < len(blue_queue) else b
+class _RGBTrail:
+    """ Internal per-frame state of the rgb trail.
+    History lives in one preallocated (max_lag + 1, H, W, 3) ring buffer,
+    the lagged channels are gathered from it straight into the output frame """
+    stateful = True
+
+    def __init__(self, red_lag=0, green_lag=5, blue_lag=10, seed=None, schedule=None):
+        self.red_lag, self.green_lag, self.blue_lag = red_lag, green_lag, blue_lag
+        self.ring_size = max(red_lag, green_lag, blue_lag) + 1
+        self.warmup_frames = self.ring_size - 1  # chunked rendering: frames needed to refill the history
+        self.seed = seed
+        # explicit activation schedule: sorted (start_frame, end_frame) ranges, end exclusive
+        self.schedule = sorted(schedule) if schedule is not None else None
+        self.ring = None
+        self.fps = 30
+        self.seek(0)
+
+    def open(self, width, height, fps):
+        self.fps = fps
+        self.ring = np.empty((self.ring_size, height, width, 3), dtype=np.uint8)
+
+    def seek(self, frame_index):
+        """ Start at frame_index with the same activations a render from frame 0 would have """
+        self.rng = random.Random(self.seed)
+        self.frame_count = 0
+        self.effect_active = False
+        self.effect_end_frame = 0
+        self.schedule_index = 0
+        for _ in range(frame_index):
+            self._advance()
+        self.stored = 0  # frames in the ring buffer
+
+    def _advance(self):
+        """ Internal function deciding whether the effect is active on the current frame """
+        if self.schedule is not None:
+            while self.schedule_index < len(self.schedule) and self.schedule[self.schedule_index][1] <= self.frame_count:
+                self.schedule_index += 1
+            active = (self.schedule_index < len(self.schedule)
+                      and self.schedule[self.schedule_index][0] <= self.frame_count)
         else:
-            r_lagged, g_lagged, b_lagged = r, g, b
-
-        aberrated_frame = cv2.merge((b_lagged, g_lagged, r_lagged))
-
-        # Ensure frames are written in sync with exact time progression
-        current_time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000  # Get current time in seconds
-        if current_time > prev_time:  # Only write if the time progresses
-            out.write(aberrated_frame)
-            prev_time = current_time
-
-        frame_count += 1
-        if frame_count % 100 == 0 or frame_count == total_frames:
-            print(f"RGB Trail: Processed {frame_count} / {total_frames} frames")
+            # Handle effect activation with a random chance
+            if not self.effect_active and self.rng.random() < 0.01:  # 1% chance per frame
+                self.effect_active = True
+                effect_duration = self.rng.randint(int(self.fps * 1), int(self.fps * 3))  # Duration between 1 to 3 seconds
+                self.effect_end_frame = self.frame_count + effect_duration
+            if self.effect_active and self.frame_count >= self.effect_end_frame:
+                self.effect_active = False
+            active = self.effect_active
+        self.frame_count += 1
+        return active
+
+    def _lagged(self, position, lag):
+        """ Internal function returning the ring slot lag frames back, or the current one
+        while the history is still shorter than lag """
+        return (position - lag) % self.ring_size if lag < self.stored else position
+
+    def __call__(self, frame):
+        if self.ring is None or self.ring.shape[1:] != frame.shape:
+            self.ring = np.empty((self.ring_size,) + frame.shape, dtype=np.uint8)
+        position = self.frame_count % self.ring_size
+        self.ring[position] = frame
+        self.stored = min(self.stored + 1, self.ring_size)
+
+        if not self._advance():
+            return frame  # pass through, no copy
+
+        # take channel 0 of the blue source, 1 of the green and 2 of the red (channels numbered across sources)
+        aberrated_frame = np.empty_like(frame)
+        sources = [self.ring[self._lagged(position, self.blue_lag)],
+                   self.ring[self._lagged(position, self.green_lag)],
+                   self.ring[self._lagged(position, self.red_lag)]]
+        cv2.mixChannels(sources, [aberrated_frame], [0, 0, 4, 1, 8, 2])
+        return aberrated_frame
+
+
+def rgb_trail_schedule(total_frames, fps, seed=None, chance=0.01):
+    """ Precompute the (start_frame, end_frame) ranges in which the rgb trail is active,
+    same rules as the random trigger: chance per frame, duration [1, 3] seconds """
+    rng = random.Random(seed)
+    schedule = []
+    frame = 0
+    while frame < total_frames:
+        if rng.random() < chance:
+            effect_duration = rng.randint(int(fps * 1), int(fps * 3))
+            schedule.append((frame, frame + effect_duration))
+            frame += effect_duration + 1  # the trigger can fire again one frame after it ended
+        else:
+            frame += 1
+    return schedule
 
-    cap.release()
-    out.release()
 
-    _add_audio(video_input_path, temp_video, video_output_path)
-    if os.path.exists(temp_video):
-        os.remove(temp_video)
+def rgb_trail(video_input_path, video_output_path, red_lag=0, green_lag=5, blue_lag=10, workers=0,
+              seed=None, schedule=None):
+    """ Applies a lag to RGB Channels.
+        lag unit    : fps
+        trigger     : % chance
+        duration    : [1, 3] seconds
+        workers     : > 0 overlaps decoding, processing and encoding in threads
+        seed        : makes the random trigger reproducible
+        schedule    : explicit [(start_frame, end_frame)] activations instead of the random trigger,
+                      see rgb_trail_schedule """
+    process_video_frames(video_input_path, video_output_path,
+                         _RGBTrail(red_lag, green_lag, blue_lag, seed, schedule), label="RGB Trail", workers=workers)
+
+
+def rgb_trail_effect(red_lag=0, green_lag=5, blue_lag=10, seed=None, schedule=None):
+    """ Per-frame rgb trail for apply_effect_chain, keeps its own channel history """
+    return _RGBTrail(red_lag, green_lag, blue_lag, seed, schedule)
 
 
 def apply_slow_motion(input_video, output_video, slow_down_factor=0.5):
@@ -0,0 +1,426 @@
+import os
+import cv2
+import time
+import random
+import tempfile
+import numpy as np
+import queue
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _open_encoder(video_input, video_output, width, height, fps):
+    """ Internal function starting one ffmpeg that encodes raw BGR frames from stdin
+    and takes the audio straight from the input video, no temporary file needed.
+    video_input None: video only, used for chunks that are joined later """
+    command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'rawvideo', # input 1: raw frames on stdin
+        '-pix_fmt', 'bgr24',
+        '-s', f'{width}x{height}',
+        '-framerate', str(fps),
+        '-i', 'pipe:0',
+    ]
+    if video_input is not None:
+        command += [
+            '-i', video_input, # input 2: original video for its audio
+            '-map', '0:v:0',
+            '-map', '1:a:0?', # audio is optional
+            '-c:a', 'aac',
+        ]
+    command += [
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-pix_fmt', 'yuv420p',
+        '-loglevel', 'error',
+        video_output
+    ]
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _close_encoder(encoder, label):
+    """ Internal function to finish an encoder and raise if ffmpeg failed """
+    try:
+        encoder.stdin.close()
+    except BrokenPipeError:
+        pass
+    errors = encoder.stderr.read().decode('utf-8', errors='replace')
+    encoder.wait()
+    if encoder.returncode != 0:
+        raise RuntimeError(f"{label}: FFmpeg failed: {errors}")
+
+
+def _read_frames(cap):
+    """ Internal generator yielding (frame, write) for every decoded frame.
+    write is False for frames whose timestamp does not progress, those are processed but dropped """
+    prev_time = -1
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        current_time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000  # Get current time in seconds
+        yield frame, current_time > prev_time
+        prev_time = max(prev_time, current_time)
+
+
+def _write_outputs(encoder, result, write_flags):
+    """ Internal function writing what process_frame returned.
+    A frame answers the oldest input still waiting, a list answers several,
+    None holds the input back (effects that look ahead, released later or by flush()) """
+    if result is None:
+        return
+    for processed_frame in (result if isinstance(result, list) else [result]):
+        if write_flags.popleft():
+            encoder.stdin.write(processed_frame.tobytes())
+
+
+def _flush(encoder, process_frame, write_flags):
+    """ Internal function writing the frames an effect still holds after the last input """
+    if hasattr(process_frame, "flush"):
+        _write_outputs(encoder, process_frame.flush(), write_flags)
+
+
+def _run_sequential(cap, encoder, process_frame, total_frames, label):
+    """ Internal function: decode, process and write one frame after another """
+    frame_count = 0
+    write_flags = deque()
+    for frame, write in _read_frames(cap):
+        write_flags.append(write)
+        _write_outputs(encoder, process_frame(frame), write_flags)
+
+        frame_count += 1
+        if frame_count % 100 == 0 or frame_count == total_frames:
+            print(f"{label}: Processed {frame_count} / {total_frames} frames")
+    _flush(encoder, process_frame, write_flags)
+    return frame_count
+
+
+def _run_pipelined(cap, encoder, process_frame, total_frames, label, workers, queue_depth):
+    """ Internal function: reader thread -> worker threads -> writer (this thread).
+    OpenCV and numpy release the GIL, so decoding, processing and encoding overlap.
+    Frames carry their index and are written back in order. At most
+    2 * queue_depth + workers frames are in flight, which keeps memory bounded """
+    input_queue = queue.Queue(maxsize=queue_depth)
+    output_queue = queue.Queue(maxsize=queue_depth)
+    in_flight = threading.Semaphore(2 * queue_depth + workers)
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for frame_index, (frame, write) in enumerate(_read_frames(cap)):
+                in_flight.acquire()
+                if stop.is_set():
+                    break
+                input_queue.put((frame_index, frame, write))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for _ in range(workers):
+                input_queue.put(None)
+
+    def worker():
+        while True:
+            item = input_queue.get()
+            if item is None:
+                break
+            frame_index, frame, write = item
+            if not stop.is_set():
+                try:
+                    frame = process_frame(frame)
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+            output_queue.put((frame_index, frame, write))
+        output_queue.put(None)
+
+    threads = [threading.Thread(target=reader, daemon=True)]
+    threads += [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    pending = {}
+    write_flags = deque()
+    next_index = 0
+    finished_workers = 0
+    occupancy = [0, 0, 0]  # samples, input queue, output queue
+    try:
+        while finished_workers < workers:
+            item = output_queue.get()
+            occupancy[0] += 1
+            occupancy[1] += input_queue.qsize()
+            occupancy[2] += output_queue.qsize()
+            if item is None:
+                finished_workers += 1
+                continue
+            frame_index, frame, write = item
+            pending[frame_index] = (frame, write)
+            # restore frame order
+            while next_index in pending:
+                result, write = pending.pop(next_index)
+                write_flags.append(write)
+                if not stop.is_set():
+                    _write_outputs(encoder, result, write_flags)
+                in_flight.release()
+                next_index += 1
+                if next_index % 100 == 0 or next_index == total_frames:
+                    print(f"{label}: Processed {next_index} / {total_frames} frames")
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        stop.set()
+        # unblock the reader and the workers so every thread can end
+        for _ in range(2 * queue_depth + workers):
+            in_flight.release()
+        for thread in threads:
+            while thread.is_alive():
+                for pipeline_queue in (input_queue, output_queue):
+                    try:
+                        pipeline_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+                thread.join(timeout=0.01)
+
+    if errors:
+        raise errors[0]
+    _flush(encoder, process_frame, write_flags)
+    samples = max(occupancy[0], 1)
+    print(f"{label}: queue occupancy input {occupancy[1] / samples:.1f} / {queue_depth}, "
+          f"output {occupancy[2] / samples:.1f} / {queue_depth}")
+    return next_index
+
+
+def _keyframe_times(video_input):
+    """ Internal function listing the keyframe timestamps of the first video stream,
+    read from the packet flags so nothing has to be decoded """
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        video_input
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def _chunk_ranges(video_input, total_frames, fps, chunks):
+    """ Internal function splitting [0, total_frames) into about `chunks` frame ranges
+    that start on source keyframes, so every chunk can seek straight to its start """
+    keyframes = [round(t * fps) for t in _keyframe_times(video_input)]
+    starts = [0]
+    for chunk_index in range(1, chunks):
+        target = chunk_index * total_frames // chunks
+        # snap to the first keyframe at or after the even split, fall back to the split itself
+        start = next((frame for frame in keyframes if frame >= target), None) if keyframes else target
+        if start is not None and starts[-1] < start < total_frames:
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [total_frames]))
+
+
+def _render_chunk(video_input, chunk_output, process_frame, width, height, fps, start_frame, end_frame, warmup_frames,
+                  lookahead_frames=0):
+    """ Internal function run in a worker process: decode frames
+    [start_frame - warmup_frames, end_frame + lookahead_frames), feed all of them to process_frame
+    but only encode [start_frame, end_frame).
+    The warm-up fills effect state such as trail queues or the previous mask, which hides the seam,
+    the look-ahead lets effects that hold frames back finish the last frames of the chunk like an unsplit render """
+    random.seed()  # forked workers would otherwise share one random sequence
+    first_frame = max(start_frame - warmup_frames, 0)
+    decoder = subprocess.Popen([
+        'ffmpeg',
+        '-ss', f"{(first_frame - 0.5) / fps:.6f}" if first_frame else '0', # half a frame early: lands on first_frame
+        '-i', video_input,
+        '-map', '0:v:0',
+        '-frames:v', str(end_frame + lookahead_frames - first_frame), # stop at the end of the chunk
+        '-fps_mode', 'passthrough',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'bgr24',
+        '-loglevel', 'error',
+        'pipe:1'
+    ], stdout=subprocess.PIPE)
+    if hasattr(process_frame, "open"):
+        process_frame.open(width, height, fps)
+    if hasattr(process_frame, "seek"):
+        process_frame.seek(first_frame)
+    encoder = _open_encoder(None, chunk_output, width, height, fps)
+
+    frame_size = width * height * 3
+    write_flags = deque()
+    try:
+        for frame_index in range(first_frame, end_frame + lookahead_frames):
+            data = decoder.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            frame = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3).copy()
+            write_flags.append(start_frame <= frame_index < end_frame)
+            _write_outputs(encoder, process_frame(frame), write_flags)
+        _flush(encoder, process_frame, write_flags)
+    finally:
+        decoder.stdout.close()
+        decoder.terminate()
+        decoder.wait()
+        if hasattr(process_frame, "close"):
+            process_frame.close()
+        _close_encoder(encoder, f"chunk {start_frame}")
+    return chunk_output
+
+
+def _process_in_chunks(video_input, video_output, process_frame, width, height, fps, total_frames,
+                       label, processes, warmup_frames):
+    """ Internal function rendering keyframe-aligned chunks in a process pool and
+    joining them without re-encoding, the audio is muxed in the same join """
+    ranges = _chunk_ranges(video_input, total_frames, fps, processes)
+    lookahead_frames = getattr(process_frame, "lookahead_frames", 0)
+    print(f"{label}: rendering {len(ranges)} chunks in {processes} processes")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        chunk_files = [os.path.join(temp_dir, f"chunk{index:04d}.mp4") for index in range(len(ranges))]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [
+                pool.submit(_render_chunk, video_input, chunk_file, process_frame, width, height, fps,
+                            start_frame, end_frame, warmup_frames, lookahead_frames)
+                for chunk_file, (start_frame, end_frame) in zip(chunk_files, ranges)
+            ]
+            for future in futures:
+                future.result()
+
+        concat_file = os.path.join(temp_dir, "chunks.txt")
+        with open(concat_file, 'w') as f:
+            for chunk_file in chunk_files:
+                f.write(f"file '{chunk_file}'\n")
+        command = [
+            'ffmpeg',
+            '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', concat_file, # input 1: joined chunks
+            '-i', video_input, # input 2: original video for its audio
+            '-map', '0:v:0',
+            '-map', '1:a:0?',
+            '-c:v', 'copy', # chunks share encoder settings, join losslessly
+            '-c:a', 'aac',
+            '-loglevel', 'error',
+            video_output
+        ]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(f"{label}: FFmpeg failed: {result.stderr.decode('utf-8')}")
+    return total_frames
+
+
+def process_video_frames(video_input, video_output, process_frame, label="Frames", workers=0, queue_depth=8,
+                         processes=0, warmup_frames=None):
+    """ Shared frame loop: decode video_input, run process_frame(frame) -> frame on
+    every frame and stream the result into a single ffmpeg that also maps the audio.
+    process_frame may define open(width, height, fps) and close(), called before
+    the first and after the last frame, for effects that need video properties or hold resources,
+    and seek(frame_index), called when a chunk does not start at the first frame.
+    Effects that need later frames may return None to hold a frame back, a list to release
+    several at once, and define flush() -> list for the frames still held at the end,
+    lookahead_frames tells chunked rendering how far past a chunk they look.
+        workers     : 0 = run everything in this thread, > 0 = pipelined with a reader thread,
+                      this many processing threads and an ordered writer
+                      (effects with stateful = True always get a single processing thread)
+        queue_depth : frames buffered between the pipeline stages
+        processes   : > 1 = split into keyframe-aligned chunks rendered in a process pool,
+                      process_frame must be picklable and gets its own copy per chunk
+        warmup_frames : frames decoded before each chunk to fill effect state,
+                        None = process_frame.warmup_frames or 0
+    returns the number of frames processed """
+    cap = cv2.VideoCapture(video_input)
+    if not cap.isOpened():
+        raise ValueError(f"{label}: Input video cannot be opened")
+
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)  # Don't cast to int, keep the exact fps
+
+    if processes > 1:
+        cap.release()
+        if warmup_frames is None:
+            warmup_frames = getattr(process_frame, "warmup_frames", 0)
+        start_time = time.perf_counter()
+        frame_count = _process_in_chunks(video_input, video_output, process_frame, frame_width, frame_height,
+                                         fps, total_frames, label, processes, warmup_frames)
+        elapsed = time.perf_counter() - start_time
+        print(f"{label}: {frame_count} frames in {elapsed:.1f} s ({frame_count / max(elapsed, 1e-9):.1f} fps)")
+        print(f"Final video saved to {video_output}")
+        return frame_count
+
+    if workers and getattr(process_frame, "stateful", False):
+        workers = 1  # frames depend on each other, keep them in one thread and in order
+
+    if hasattr(process_frame, "open"):
+        process_frame.open(frame_width, frame_height, fps)
+    encoder = _open_encoder(video_input, video_output, frame_width, frame_height, fps)
+
+    start_time = time.perf_counter()
+    frame_count = 0
+    try:
+        if workers:
+            frame_count = _run_pipelined(cap, encoder, process_frame, total_frames, label, workers, queue_depth)
+        else:
+            frame_count = _run_sequential(cap, encoder, process_frame, total_frames, label)
+    except BrokenPipeError:
+        pass  # encoder died, reported below
+    finally:
+        cap.release()
+        if hasattr(process_frame, "close"):
+            process_frame.close()
+        _close_encoder(encoder, label)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{label}: {frame_count} frames in {elapsed:.1f} s ({frame_count / max(elapsed, 1e-9):.1f} fps)")
+    print(f"Final video saved to {video_output}")
+    return frame_count
+
+
+class EffectChain:
+    """ Ordered list of per-frame effects applied one after another to every frame,
+    so several effects cost one decode and one encode. open()/close() are forwarded
+    to the effects that define them """
+
+    def __init__(self, effects):
+        self.effects = list(effects)
+        self.stateful = any(getattr(effect, "stateful", False) for effect in self.effects)
+        self.warmup_frames = max([getattr(effect, "warmup_frames", 0) for effect in self.effects] + [0])
+
+    def open(self, width, height, fps):
+        for effect in self.effects:
+            if hasattr(effect, "open"):
+                effect.open(width, height, fps)
+
+    def close(self):
+        for effect in self.effects:
+            if hasattr(effect, "close"):
+                effect.close()
+
+    def seek(self, frame_index):
+        for effect in self.effects:
+            if hasattr(effect, "seek"):
+                effect.seek(frame_index)
+
+    def __call__(self, frame):
+        for effect in self.effects:
+            frame = effect(frame)
+        return frame
+
+
+def apply_effect_chain(video_input, video_output, effects, workers=0, processes=0):
+    """ Function to apply several effects in a single pass
+        effects   : ordered list, e.g. [teal_orange_effect(0.8), black_white_effect(), rgb_trail_effect()]
+        workers   : processing threads, 0 = no pipelining
+        processes : > 1 renders chunks of the video in parallel processes """
+    process_video_frames(video_input, video_output, EffectChain(effects), label="Effects", workers=workers,
+                         processes=processes)
@@ -0,0 +1,147 @@
+import os
+import heapq
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def video_size(video_file):
+    """ (width, height) of a video """
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Cannot open video file: {video_file}")
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return size
+
+
+def clip_layer(text_clip, position, frame_size):
+    """ Rasterise a MoviePy TextClip once as a layer (x, y, rgb, alpha),
+    placed like text_clip.with_position(position) in a frame of frame_size
+        position : (x, y), numbers or 'left' / 'center' / 'right', 'top' / 'center' / 'bottom' """
+    rgb = text_clip.get_frame(0)
+    alpha = text_clip.mask.get_frame(0) if text_clip.mask is not None else np.ones(rgb.shape[:2], dtype=np.float32)
+    height, width = rgb.shape[:2]
+    frame_width, frame_height = frame_size
+    x, y = position
+    x = {'left': 0, 'center': (frame_width - width) / 2, 'right': frame_width - width}.get(x, x)
+    y = {'top': 0, 'center': (frame_height - height) / 2, 'bottom': frame_height - height}.get(y, y)
+    return int(x), int(y), rgb, alpha
+
+
+def composite_layers(layers, width, height, left=0, top=0):
+    """ Composite layers (x, y, rgb, alpha) in order, later ones over earlier ones,
+    into a width x height image whose top left corner is (left, top) of the frame.
+    Layers are cropped to the image. returns (rgb uint8, alpha float32) """
+    image_rgb = np.zeros((height, width, 3), dtype=np.float32)
+    image_alpha = np.zeros((height, width), dtype=np.float32)
+    for x, y, rgb, alpha in layers:
+        x, y = x - left, y - top
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + rgb.shape[1], width), min(y + rgb.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        source = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        region = (slice(y0, y1), slice(x0, x1))
+        layer_alpha = alpha[source][..., None]
+        # "over": premultiplied color and coverage
+        image_rgb[region] = rgb[source] * layer_alpha + image_rgb[region] * (1 - layer_alpha)
+        image_alpha[region] = alpha[source] + image_alpha[region] * (1 - alpha[source])
+    # back to straight color, transparent pixels stay black
+    np.divide(image_rgb, image_alpha[..., None], out=image_rgb, where=image_alpha[..., None] > 0)
+    return np.clip(np.rint(image_rgb), 0, 255).astype(np.uint8), image_alpha
+
+
+def _pack_lanes(blocks):
+    """ Internal function: interval partitioning of the blocks into lanes of blocks that
+    do not overlap in time, using as few lanes as lines are shown at the same time.
+    returns [[block index, ...] sorted by start] """
+    order = sorted(range(len(blocks)), key=lambda index: (blocks[index][0], blocks[index][1]))
+    lanes = []
+    lane_ends = []  # heap of (end of the last block, lane index)
+    for index in order:
+        start, end = blocks[index][0], blocks[index][1]
+        if lane_ends and lane_ends[0][0] <= start:
+            _, lane = heapq.heappop(lane_ends)
+        else:
+            lane = len(lanes)
+            lanes.append([])
+        lanes[lane].append(index)
+        heapq.heappush(lane_ends, (end, lane))
+    return lanes
+
+
+def _write_lane(lane, blocks, block_files, blank_file, lane_file):
+    """ Internal function writing one lane as an ffconcat list of still images:
+    every block image starts at its start time, transparent images fill the gaps.
+    framerate 1000 keeps the image timestamps at millisecond precision (image2 default: 1/25 s) """
+    entries = []
+    current_time = 0.0
+    for index in lane:
+        start, end = blocks[index][0], blocks[index][1]
+        if start > current_time:
+            entries.append((blank_file, start - current_time))
+        entries.append((block_files[index], end - start))
+        current_time = end
+    with open(lane_file, 'w') as f:
+        f.write("ffconcat version 1.0\n")
+        for image_file, duration in entries:
+            f.write(f"file '{image_file}'\noption framerate 1000\nduration {duration:.3f}\n")
+        f.write(f"file '{blank_file}'\noption framerate 1000\n")  # the last entry has no duration
+
+
+def render_lyric_overlays(video_file, output_file, blocks):
+    """ Burn timed overlays into a video in a single ffmpeg pass.
+    Every block is rendered once to a PNG, blocks are packed into lanes that never show two
+    blocks at once, and each lane is one overlay whose enable expression covers its blocks
+        blocks : [(start, end, layers)], layers as returned by clip_layer, composited in order """
+    # millisecond times, lane durations are differences of the same rounded values and do not drift
+    blocks = [(round(start, 3), round(end, 3), layers) for start, end, layers in blocks]
+    blocks = [block for block in blocks if block[1] > block[0] and block[2]]
+    if not blocks:
+        print("No lyrics to add, skipping video creation.")
+        return
+    width, height = video_size(video_file)
+    lanes = _pack_lanes(blocks)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        blank_file = os.path.join(temp_dir, "blank.png")
+        Image.new('RGBA', (width, height), (0, 0, 0, 0)).save(blank_file)
+        block_files = []
+        for index, (_, _, layers) in enumerate(blocks):
+            rgb, alpha = composite_layers(layers, width, height)
+            rgba = np.dstack([rgb, np.rint(alpha * 255).astype(np.uint8)])
+            block_files.append(os.path.join(temp_dir, f"block{index:05d}.png"))
+            Image.fromarray(rgba, 'RGBA').save(block_files[-1], compress_level=1)
+
+        cmd = ['ffmpeg', '-i', video_file]
+        graph = []
+        previous = "0:v"
+        for lane_index, lane in enumerate(lanes, start=1):
+            lane_file = os.path.join(temp_dir, f"lane{lane_index}.txt")
+            _write_lane(lane, blocks, block_files, blank_file, lane_file)
+            cmd += ['-f', 'concat', '-safe', '0', '-i', lane_file]
+            # shown while start <= t < end, like a clip with start and duration
+            enable = "+".join(f"gte(t,{blocks[index][0]:.3f})*lt(t,{blocks[index][1]:.3f})" for index in lane)
+            graph.append(f"[{previous}][{lane_index}:v]overlay=format=auto:enable='{enable}'[lane{lane_index}]")
+            previous = f"lane{lane_index}"
+        # the graph grows with the number of lines, pass it as a file instead of an argument
+        filter_script = os.path.join(temp_dir, "lyrics_filtergraph.txt")
+        with open(filter_script, 'w') as f:
+            f.write(";\n".join(graph))
+        cmd += [
+            '-filter_complex_script', filter_script,
+            '-map', f'[{previous}]',
+            '-map', '0:a?',  # original audio, if any
+            '-c:v', 'libx264',
+            '-c:a', 'aac',
+            '-loglevel', 'error',
+            '-y',
+            output_file
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(f"FFmpeg failed: {result.stderr.decode('utf-8')}")
+    print(f"Video saved to {output_file}")
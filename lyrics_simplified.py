@@ -1,26 +1,38 @@
+from functools import lru_cache
 from moviepy import *
+from lyrics_overlay import clip_layer, composite_layers, render_lyric_overlays, video_size
 
 
-def sync_lyrics_manually(lyrics, video_input_file, video_output_file, color=(255, 255, 255, 255)):
+def sync_lyrics_manually(lyrics, video_input_file, video_output_file, color=(255, 255, 255, 255), backend="ffmpeg"):
     """ Function to place the text in a simple manner using manual timestamps
-    Customisation : font, color, position"""
-    video_clip = VideoFileClip(video_input_file)
+    Customisation : font, color, position
+        backend : ffmpeg (every line rendered once, composited in one ffmpeg pass) or moviepy"""
+    if backend not in ("ffmpeg", "moviepy"):
+        raise ValueError(f"Unknown lyrics backend: {backend}")
+    video_clip = VideoFileClip(video_input_file) if backend == "moviepy" else None
+    frame_size = video_size(video_input_file)
     text_clips = []
+    blocks = []
 
     for start_time, end_time, lyric in lyrics:
         text_clip = TextClip(
             text=lyric,
             font='Helvetica', # use any locally installed font
             color=color, # RGB, RGBA, Hex, name
-            size=(video_clip.w, None)
+            size=(frame_size[0], None)
         )
+        if backend == "ffmpeg":
+            blocks.append((start_time, end_time, [clip_layer(text_clip, ('center', 'top'), frame_size)]))
+            continue
         text_clip = (text_clip.with_position('center', 'top')
                      .with_duration(end_time - start_time)
                      .with_start(start_time))
 
         text_clips.append(text_clip)
 
-    if text_clips:
+    if backend == "ffmpeg":
+        render_lyric_overlays(video_input_file, video_output_file, blocks)
+    elif text_clips:
         final_clip = CompositeVideoClip([video_clip] + text_clips)
         final_clip.audio = video_clip.audio
         final_clip.write_videofile(video_output_file, codec='libx264', audio_codec='aac')
@@ -30,8 +42,97 @@ def sync_lyrics_manually(lyrics, video_input_file, video_output_file, color=(255
 
 
 
-def sync_lyrics_grid_to_video(lyrics_lines, video_file, output_file, color=(255, 255, 255, 255), grid_size=(5, 12), first_letter_scale=1.8):
+@lru_cache(maxsize=4096)
+def _glyph(char, width, height, font, color, stroke_width, stroke_color):
+    """ Internal function: glyph atlas, each distinct character, box, font, color and stroke
+    is rasterised once. Returns (rgb uint8, alpha float) of the box """
+    char_clip = TextClip(
+        text=char,
+        font=font,
+        color=color,
+        size=(width, height),
+        stroke_width=stroke_width,
+        stroke_color=stroke_color,
+        method='label' # autosize letters
+    )
+    return char_clip.get_frame(0), char_clip.mask.get_frame(0)
+
+
+def _grid_layout(lyric_line, video_width, video_height, grid_size, first_letter_scale):
+    """ Internal function placing the characters of one line in the grid
+    returns [(char, x_pos, y_pos, char_width, cell_height)] """
+    # Calculate grid cell dimensions
+    rows, cols = grid_size
+    cell_width = video_width / cols
+    cell_height = video_height / rows
+
+    placed = []
+    words = lyric_line.split()  # Split lyric into words
+    current_row = 0
+    current_col = 0
+
+    for word in words:
+        # Reserve space for the first letter
+        first_letter_space = first_letter_scale
+
+        # Total number of cells needed
+        word_length_in_cells = first_letter_space + len(word) - 1
+
+        # check space available in row
+        if current_col + word_length_in_cells > cols:
+            current_col = 0
+            current_row += 1
+
+        if current_row >= rows:
+            print(f"Warning: No space left in the grid for word: '{word}'. Split list entry further")
+            break
+
+        # Place each character in the grid
+        for idx, char in enumerate(word):
+            if idx == 0:  # First letter
+                char_width = cell_width * first_letter_scale
+            else:
+                char_width = cell_width
+
+            x_pos = current_col * cell_width
+            y_pos = current_row * cell_height
+            placed.append((char, x_pos, y_pos, char_width, cell_height))
+
+            if idx == 0:
+                current_col += first_letter_scale  # Add space for the larger first letter
+            else:
+                current_col += 1  # Regular spacing for subsequent letters
+        current_col += 1 # blank space after each word
+    return placed
+
+
+def _glyph_layers(placed, font, color, stroke_width, stroke_color):
+    """ Internal function looking up the glyphs of one line: [(x, y, rgb, alpha)] """
+    layers = []
+    for char, x_pos, y_pos, char_width, cell_height in placed:
+        rgb, alpha = _glyph(char, int(char_width) + 50, int(cell_height) + 50, font, color, stroke_width, stroke_color)
+        layers.append((int(x_pos), int(y_pos), rgb, alpha))
+    return layers
+
+
+def _render_line(layers):
+    """ Internal function compositing the glyphs of one line into a single image,
+    later characters over earlier ones like separate clips would be
+    returns (x, y, rgb, alpha) or None for an empty line """
+    if not layers:
+        return None
+    left = min(x for x, _, _, _ in layers)
+    top = min(y for _, y, _, _ in layers)
+    right = max(x + rgb.shape[1] for x, _, rgb, _ in layers)
+    bottom = max(y + rgb.shape[0] for _, y, rgb, _ in layers)
+    line_rgb, line_alpha = composite_layers(layers, right - left, bottom - top, left, top)
+    return left, top, line_rgb, line_alpha
+
+
+def sync_lyrics_grid_to_video(lyrics_lines, video_file, output_file, color=(255, 255, 255, 255), grid_size=(5, 12),
+                              first_letter_scale=1.8, font='Futura', backend="ffmpeg"):
     """ Function to place text in a more advanced manner using manual timestamps and a grid layout
+        Every distinct letter is rasterised once and each line becomes a single overlay
         Customisaton :
         grid_size (r X c): ensure minimum # columns = longest word + 1 or letters might be cut off
         first_letter_scale: first letter of each word is scaled
@@ -41,72 +142,41 @@ def sync_lyrics_grid_to_video(lyrics_lines, video_file, output_file, color=(255,
         stroke_width : border thickness
         stroke_color : border color
         method : label (autosized) or caption (absolute size)
+        backend : ffmpeg (lines composited in one ffmpeg pass) or moviepy
         """
-    video_clip = VideoFileClip(video_file)
-    video_width, video_height = video_clip.w, video_clip.h
-
-    # Calculate grid cell dimensions
-    rows, cols = grid_size
-    cell_width = video_width / cols
-    cell_height = video_height / rows
+    if backend not in ("ffmpeg", "moviepy"):
+        raise ValueError(f"Unknown lyrics backend: {backend}")
+    video_clip = VideoFileClip(video_file) if backend == "moviepy" else None
+    video_width, video_height = video_size(video_file)
+    color = tuple(color) if isinstance(color, list) else color  # glyph atlas key
 
     text_clips = []
+    blocks = []
 
     for start_time, end_time, lyric_line in lyrics_lines:
-        words = lyric_line.split()  # Split lyric into words
-        current_row = 0
-        current_col = 0
-
-        for word in words:
-            # Reserve space for the first letter
-            first_letter_space = first_letter_scale
-
-            # Total number of cells needed
-            word_length_in_cells = first_letter_space + len(word) - 1
-
-            # check space available in row
-            if current_col + word_length_in_cells > cols:
-                current_col = 0
-                current_row += 1
-
-            if current_row >= rows:
-                print(f"Warning: No space left in the grid for word: '{word}'. Split list entry further")
-                break
-
-            # Place each character in the grid
-            for idx, char in enumerate(word):
-                if idx == 0:  # First letter
-                    char_width = cell_width * first_letter_scale
-                else:
-                    char_width = cell_width
-
-                x_pos = current_col * cell_width
-                y_pos = current_row * cell_height
-
-                # Customisation
-                char_clip = TextClip(
-                    text=char,
-                    font='Futura', # use any locally installed font
-                    color=color, # RGB, RGBA, Hex, name
-                    size=(int(char_width)+50, int(cell_height)+50),
-                    stroke_width=8,
-                    stroke_color=(125, 125, 125),
-                    method='label' # autosize letters
-                ).with_position((x_pos, y_pos)).with_duration(end_time - start_time).with_start(start_time)
-
-                text_clips.append(char_clip)
-
-                if idx == 0:
-                    current_col += first_letter_scale  # Add space for the larger first letter
-                else:
-                    current_col += 1  # Regular spacing for subsequent letters
-            current_col += 1 # blank space after each word
-
-    if text_clips:
+        placed = _grid_layout(lyric_line, video_width, video_height, grid_size, first_letter_scale)
+        # Customisation
+        layers = _glyph_layers(placed, font, color, stroke_width=8, stroke_color=(125, 125, 125))
+        if backend == "ffmpeg":
+            blocks.append((start_time, end_time, layers))
+            continue
+        line = _render_line(layers)
+        if line is None:
+            continue
+        x_pos, y_pos, line_rgb, line_alpha = line
+        line_clip = (ImageClip(line_rgb)
+                     .with_mask(ImageClip(line_alpha, is_mask=True))
+                     .with_position((x_pos, y_pos))
+                     .with_duration(end_time - start_time)
+                     .with_start(start_time))
+        text_clips.append(line_clip)
+
+    if backend == "ffmpeg":
+        render_lyric_overlays(video_file, output_file, blocks)
+    elif text_clips:
         final_clip = CompositeVideoClip([video_clip] + text_clips)
         final_clip.audio = video_clip.audio
         final_clip.write_videofile(output_file, codec='libx264', audio_codec='aac')
         print(f"Video saved to {output_file}")
     else:
         print("No lyrics to add, skipping video creation.")
-
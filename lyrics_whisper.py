@@ -1,8 +1,11 @@
 import pandas as pd
 import whisper
 import re
+from functools import lru_cache
 from moviepy import *
 import syllapy  # Library to split text into syllables
+import cache
+from lyrics_overlay import clip_layer, render_lyric_overlays, video_size
 
 
 def _load_lyrics(csv_file, song_id):
@@ -18,15 +21,25 @@ def _load_lyrics(csv_file, song_id):
     song_lyrics.loc[:, 'lyric'] = song_lyrics['lyric'].apply(lambda x: re.sub(r'<.*?>', '', x).strip())
     return song_lyrics
 
+@lru_cache(maxsize=1)
+def _whisper_model(model_name):
+    """ Internal function loading a whisper model once, reused for every song """
+    return whisper.load_model(model_name)
+
 # Function to detect vocal segments with Whisper (including word-level timestamps)
-def _detect_vocal_segments_with_whisper(audio_file):
-    model = whisper.load_model("base")
-    result = model.transcribe(audio_file, word_timestamps=True, language='de')  # Adjust language code as needed
+def _detect_vocal_segments_with_whisper(audio_file, model_name="base", language="de"):
+    """ Word timestamps [(start, end, word)], cached by audio content, model and language
+    so restyling the lyrics never transcribes again """
+    key = cache.cache_key(cache.file_hash(audio_file), "word_timestamps", model_name, language)
+    timestamps = cache.load("transcripts", key)
+    if timestamps is not None:
+        return timestamps
+    result = _whisper_model(model_name).transcribe(audio_file, word_timestamps=True, language=language)
     timestamps = []
     for segment in result['segments']:
         for word_info in segment['words']:
             timestamps.append((word_info['start'], word_info['end'], word_info['word']))
-    return timestamps
+    return cache.store("transcripts", key, timestamps)
 
 
 def _split_into_syllables(lyric):
@@ -82,29 +95,41 @@ def _match_lyrics_to_speech(lyrics_df, timestamps):
     return matched_lyrics
 
 
-def _sync_lyrics_to_video(matched_lyrics, video_file, output_file):
-    video_clip = VideoFileClip(video_file)
+def _sync_lyrics_to_video(matched_lyrics, video_file, output_file, backend="ffmpeg"):
+    """ backend : ffmpeg (both text lines of a lyric rendered once, composited in one ffmpeg pass) or moviepy """
+    if backend not in ("ffmpeg", "moviepy"):
+        raise ValueError(f"Unknown lyrics backend: {backend}")
+    video_clip = VideoFileClip(video_file) if backend == "moviepy" else None
+    frame_size = video_size(video_file)
     text_clips = []
     second_text_clips = []  # For the second set of lyrics (with different color and position)
+    blocks = []
 
     for start_time, end_time, lyric in matched_lyrics:
         # First text clip (original)
         text_clip = TextClip(text=lyric,
                              font='Helvetica',
                              color=(255, 255, 255, 255),
-                             size=(video_clip.w, None))
-        text_clip = (text_clip.with_position('center', 'top')).with_duration(end_time - start_time).with_start(
-            start_time)
+                             size=(frame_size[0], None))
 
         # Second text clip (different color and position)
-        second_text_clip = TextClip(text=lyric, font='Helvetica', color=(192, 192, 192, 128), size=(video_clip.w, None))
+        second_text_clip = TextClip(text=lyric, font='Helvetica', color=(192, 192, 192, 128), size=(frame_size[0], None))
+
+        if backend == "ffmpeg":
+            blocks.append((start_time, end_time, [clip_layer(text_clip, ('center', 'top'), frame_size),
+                                                  clip_layer(second_text_clip, ('center', 'bottom'), frame_size)]))
+            continue
+        text_clip = (text_clip.with_position('center', 'top')).with_duration(end_time - start_time).with_start(
+            start_time)
         second_text_clip = (second_text_clip.with_position('center', 'bottom')).with_duration(
             end_time - start_time).with_start(start_time)  # Slightly lower and to the right
 
         text_clips.append(text_clip)
         second_text_clips.append(second_text_clip)
 
-    if text_clips:
+    if backend == "ffmpeg":
+        render_lyric_overlays(video_file, output_file, blocks)
+    elif text_clips:
         # Combine both the original and second set of text clips
         final_clip = CompositeVideoClip([video_clip] + text_clips + second_text_clips)
         final_clip.audio = video_clip.audio  # Retain original audio
@@ -115,11 +140,31 @@ def _sync_lyrics_to_video(matched_lyrics, video_file, output_file):
 
 
 
-def process_audio_video(csv_file, song_id, audio_file, video_file, output_file):
+def process_audio_video(csv_file, song_id, audio_file, video_file, output_file, model_name="base", language="de",
+                        backend="ffmpeg"):
+    """ Transcribe the vocals, match them to the lyrics of song_id and write them onto the video
+        model_name : whisper model size (tiny, base, small, medium, large)
+        language   : language code of the vocals
+        backend    : ffmpeg (one overlay pass) or moviepy """
     lyrics_df = _load_lyrics(csv_file, song_id)
-    timestamps = _detect_vocal_segments_with_whisper(audio_file)
+    timestamps = _detect_vocal_segments_with_whisper(audio_file, model_name, language)
     matched_lyrics = _match_lyrics_to_speech(lyrics_df, timestamps)
-    _sync_lyrics_to_video(matched_lyrics, video_file, output_file)
+    _sync_lyrics_to_video(matched_lyrics, video_file, output_file, backend)
+
+
+def process_audio_videos(csv_file, songs, model_name="base", language="de", backend="ffmpeg"):
+    """ process_audio_video for many songs with one loaded model
+        songs : [(song_id, audio_file, video_file, output_file)]
+    returns the output files written, failing songs are reported and skipped """
+    written = []
+    for song_id, audio_file, video_file, output_file in songs:
+        try:
+            process_audio_video(csv_file, song_id, audio_file, video_file, output_file, model_name, language, backend)
+        except Exception as e:
+            print(f"Error: skipping song {song_id}: {e}")
+            continue
+        written.append(output_file)
+    return written
 
 
 # Example usage:
@@ -1,4 +1,4 @@
-from video_cutting import extract_beats_from_song, cut_videos_by_song_beats, concatenate_clips_randomly
+from video_cutting import extract_beats_from_song, align_takes, plan_edit_decision_list, render_edit_decision_list
 
 import os
 
@@ -21,14 +21,14 @@ def main():
     print("Analyzing song file...")
     beat_sequence = extract_beats_from_song(audio_file)
 
-    # 02 cut videos based on beat sequence
-    print("Cutting videos based on beat sequence...")
-    clips_by_beat = cut_videos_by_song_beats(video_folder, beat_sequence, audio_file, output_dir)
+    # 02 align every take with the song
+    print("Aligning videos with the song...")
+    take_offsets = align_takes(video_folder, audio_file)
 
-
-    # 03 concatenate random clips into the final video
+    # 03 pick a random take per beat and render only those clips into the final video
     print("Combining clips into final video...")
-    concatenate_clips_randomly(clips_by_beat, beat_sequence, final_output)
+    edit_decision_list = plan_edit_decision_list(beat_sequence, take_offsets)
+    render_edit_decision_list(edit_decision_list, audio_file, final_output) # pass clips_dir to keep the cut clips
 
     # 03.2 repeat 03 if result is displeasing. If all versions should be persistent:
     # don't forget to change the name of final_output variable!
@@ -1,32 +1,184 @@
+import os
+import time
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import torch
 import openunmix
 from openunmix.utils import preprocess
 import librosa
 import numpy as np
 import soundfile as sf
+import cache
 
-def separate_vocals(input_audio, output_audio, voc_start):
-    """ Function to separate vocals from instruments using openUnmix.
-        voc_start   : first appearance of vocals in seconds """
-    audio, sr = librosa.load(input_audio, sr=None, mono=False)  # Use input's sample rate
-    if audio.ndim == 1:
-        audio = np.stack([audio, audio], axis=0)  # Convert mono to stereo
-
-    # Mask beginning until vocals start to help unmix
-    start_sample = int(voc_start * sr)
-    vocal_mask = np.ones(audio.shape[1], dtype=np.float32)
-    vocal_mask[:start_sample] = 0
-    masked_audio = audio * vocal_mask
-
-    # Convert to PyTorch tensor
-    audio_tensor = torch.tensor(masked_audio, dtype=torch.float32)
+
+@lru_cache(maxsize=1)
+def _separator():
+    """ Internal function loading the Open-Unmix model once, reused for every song """
+    return openunmix.umxl()
+
+
+def _separate_window(separator, audio):
+    """ Internal function returning the vocals of audio, both (samples, channels) """
+    audio_tensor = torch.tensor(audio.T, dtype=torch.float32)
     processed_audio = preprocess(audio_tensor)
+    with torch.inference_mode():
+        estimates = separator(processed_audio)
+    return estimates[0, 0, :, :].cpu().numpy().T  # vocals: (channels, samples) -> (samples, channels)
+
+
+def _separate_streaming(separator, input_audio, output_audio, voc_start, window_seconds, overlap_seconds):
+    """ Internal function separating fixed-length windows one after another.
+    Consecutive windows share overlap_seconds, crossfaded linearly, and every finished
+    part is appended to output_audio right away, so memory does not grow with the song """
+    with sf.SoundFile(input_audio) as source:
+        sr = source.samplerate
+        window = int(window_seconds * sr)
+        overlap = int(overlap_seconds * sr)
+        if not 0 < overlap <= window // 2:
+            raise ValueError("overlap_seconds must be > 0 and at most half of window_seconds")
+        start_sample = int(voc_start * sr)
+        fade_in = ((np.arange(overlap, dtype=np.float32) + 0.5) / overlap)[:, None]
+
+        with sf.SoundFile(output_audio, 'w', samplerate=sr, channels=2) as sink:
+            position = 0  # first sample of the buffer in the song
+            buffer = np.empty((0, 2), dtype=np.float32)
+            tail = None  # vocals of the overlap that the previous window left open
+            while True:
+                block = source.read(window - len(buffer), dtype='float32', always_2d=True)
+                if len(block) == 0 and tail is not None:
+                    sink.write(tail)  # the song ended inside the previous window
+                    break
+                if block.shape[1] == 1:
+                    block = np.repeat(block, 2, axis=1)  # Convert mono to stereo
+                buffer = np.concatenate([buffer, block[:, :2]])
+                if len(buffer) == 0:
+                    break
+
+                # Mask beginning until vocals start to help unmix
+                masked_audio = buffer.copy()
+                masked_audio[:max(0, min(start_sample - position, len(masked_audio)))] = 0
+                vocals = _separate_window(separator, masked_audio)
+
+                if tail is not None:
+                    crossfade = min(overlap, len(vocals))
+                    vocals[:crossfade] = (tail[:crossfade] * (1 - fade_in[:crossfade])
+                                          + vocals[:crossfade] * fade_in[:crossfade])
+                    if crossfade < overlap:
+                        vocals = np.concatenate([vocals, tail[crossfade:]])
+                if len(buffer) < window:  # last window
+                    sink.write(vocals)
+                    break
+                sink.write(vocals[:-overlap])
+                tail = vocals[-overlap:]
+                buffer = buffer[-overlap:]
+                position += window - overlap
+
+
+def separate_vocals(input_audio, output_audio, voc_start, window_seconds=None, overlap_seconds=2.0, threads=None):
+    """ Function to separate vocals from instruments using openUnmix.
+    The model is loaded once per process, the vocals are cached by audio content and voc_start.
+        voc_start       : first appearance of vocals in seconds
+        window_seconds  : None = whole song at once, otherwise separate windows of this length
+                          and write the vocals while reading, memory stays flat for any length (e.g. 30)
+        overlap_seconds : crossfade between consecutive windows
+        threads         : torch threads, None = torch default """
+    extension = os.path.splitext(output_audio)[1] or ".wav"
+    key = cache.cache_key(cache.file_hash(input_audio), voc_start, window_seconds,
+                          overlap_seconds if window_seconds is not None else None)
+    cached_file = cache.entry_file("vocals", key, extension)
+    try:
+        cached = open(cached_file, 'rb')  # once open, an eviction no longer affects the copy
+    except FileNotFoundError:
+        cached = None  # not cached, or evicted by a concurrent run
+    if cached is not None:
+        with cached, open(output_audio, 'wb') as f:
+            shutil.copyfileobj(cached, f)
+        try:
+            os.utime(cached_file)  # mark as recently used for eviction
+        except OSError:
+            pass  # evicted after copying, the copy is still valid
+        print(f"Vocals: {input_audio} from cache")
+        return
+
+    if threads:
+        torch.set_num_threads(threads)
+    separator = _separator()
+
+    if window_seconds is not None:
+        _separate_streaming(separator, input_audio, output_audio, voc_start, window_seconds, overlap_seconds)
+    else:
+        audio, sr = librosa.load(input_audio, sr=None, mono=False)  # Use input's sample rate
+        if audio.ndim == 1:
+            audio = np.stack([audio, audio], axis=0)  # Convert mono to stereo
+
+        # Mask beginning until vocals start to help unmix
+        start_sample = int(voc_start * sr)
+        vocal_mask = np.ones(audio.shape[1], dtype=np.float32)
+        vocal_mask[:start_sample] = 0
+        masked_audio = audio * vocal_mask
+
+        # Perform separation and save output
+        vocals = _separate_window(separator, masked_audio.T)
+        sf.write(output_audio, vocals, sr)
+
+    temp_file = f"{cached_file}.{os.getpid()}.tmp"
+    shutil.copyfile(output_audio, temp_file)
+    os.replace(temp_file, cached_file)
+    cache.evict(keep=(cached_file,))
+
+
+def _init_batch_worker(threads):
+    """ Internal function run once in every batch process, the model is loaded by the first song needing it """
+    torch.set_num_threads(threads)
+
+
+def _separate_job(input_audio, output_audio, voc_start, window_seconds, overlap_seconds):
+    """ Internal function separating one song with the model of the process, returns seconds """
+    start_time = time.perf_counter()
+    separate_vocals(input_audio, output_audio, voc_start, window_seconds, overlap_seconds)
+    return time.perf_counter() - start_time
+
 
-    # Perform separation
-    separator = openunmix.umxl()
-    estimates = separator(processed_audio)
+def separate_vocals_batch(jobs, workers=1, window_seconds=None, overlap_seconds=2.0):
+    """ Separate the vocals of several songs with one resident model.
+        jobs    : [(input_audio, output_audio, voc_start)]
+        workers : songs separated at the same time in separate processes, each loads the model once
+                  and gets its share of the cores as torch threads. 0 = as many as cores
+        window_seconds, overlap_seconds : see separate_vocals
+    returns {input audio: output audio}, failing songs are reported and left out """
+    jobs = list(jobs)
+    if not jobs:
+        print("Error: No songs to separate.")
+        return {}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    print(f"Vocals: {len(jobs)} songs with {workers} processes")
 
-    # Extract vocals and save output
-    vocals = estimates[0, 0, :, :].detach().cpu().numpy()  # Shape: (samples, channels)
-    sf.write(output_audio, vocals.T, sr)  # .T ensures correct shape for writing
+    start_time = time.perf_counter()
+    results = {}
+    if workers == 1:
+        futures = [None] * len(jobs)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                   initargs=(max(1, (os.cpu_count() or 1) // workers),))
+        futures = [pool.submit(_separate_job, input_audio, output_audio, voc_start, window_seconds, overlap_seconds)
+                   for input_audio, output_audio, voc_start in jobs]
+    try:
+        # collect in job order, one failing song does not stop the others
+        for (input_audio, output_audio, voc_start), future in zip(jobs, futures):
+            try:
+                if future is None:
+                    seconds = _separate_job(input_audio, output_audio, voc_start, window_seconds, overlap_seconds)
+                else:
+                    seconds = future.result()
+            except Exception as e:
+                print(f"Error: skipping song {input_audio}: {e}")
+                continue
+            results[input_audio] = output_audio
+            print(f"Vocals: {os.path.basename(input_audio)} -> {output_audio} in {seconds:.1f} s")
+    finally:
+        if workers > 1:
+            pool.shutdown(cancel_futures=True)
 
+    print(f"Vocals: {len(results)} / {len(jobs)} songs in {time.perf_counter() - start_time:.1f} s")
+    return results
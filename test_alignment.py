@@ -0,0 +1,58 @@
+import numpy as np
+from scipy.signal import correlate
+from video_cutting import _estimate_lag
+
+SR = 22050
+
+
+def _click_track(rng, seconds, beat=None):
+    """ Noise with a decaying 1 kHz click of random loudness on every beat,
+    or at random times when beat is None """
+    y = 0.02 * rng.standard_normal(int(seconds * SR)).astype(np.float32)
+    t = np.arange(int(0.05 * SR)) / SR
+    click = (np.sin(2 * np.pi * 1000 * t) * np.exp(-60 * t)).astype(np.float32)
+    if beat is None:
+        starts = np.sort(rng.uniform(0, seconds - 0.05, int(seconds * 2)))
+    else:
+        starts = np.arange(0, seconds - 0.05, beat)
+    for start in starts:
+        i = int(start * SR)
+        y[i:i + len(click)] += rng.uniform(0.3, 1.0) * click
+    return y
+
+
+def _take(rng, song):
+    """ The song hidden at an arbitrary sample offset in a noisy take, possibly cut short """
+    lead = rng.standard_normal(int(rng.uniform(0, 6) * SR)).astype(np.float32)
+    tail = rng.standard_normal(int(rng.uniform(0, 4) * SR)).astype(np.float32)
+    video = np.concatenate([0.02 * lead, song[:len(song) - int(rng.uniform(0, 3) * SR)], 0.02 * tail])
+    return video + 0.01 * rng.standard_normal(len(video)).astype(np.float32)
+
+
+def _full_lag(video, song):
+    """ Lag of the maximum of the full waveform cross-correlation """
+    return int(np.argmax(correlate(video, song, mode='full', method='fft'))) - (len(song) - 1)
+
+
+def _check(beat, seed, cases=10):
+    rng = np.random.default_rng(seed)
+    for _ in range(cases):
+        song = _click_track(rng, rng.uniform(8, 20), beat)
+        video = _take(rng, song)
+        assert abs(_estimate_lag(song, video, SR) - _full_lag(video, song)) <= 1
+
+
+def test_steady_beat_matches_full_correlation():
+    # a peak on every beat, the coarse search must not settle on a neighbouring beat
+    _check(beat=0.5, seed=0)
+
+
+def test_random_onsets_match_full_correlation():
+    _check(beat=None, seed=1)
+
+
+def test_bounded_search():
+    rng = np.random.default_rng(2)
+    song = _click_track(rng, 10, 0.5)
+    video = np.concatenate([np.zeros(12345, dtype=np.float32), song])
+    assert _estimate_lag(song, video, SR, max_lag=SR) == 12345
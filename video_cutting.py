@@ -3,123 +3,718 @@ import librosa
 import librosa.display
 import subprocess
 from scipy.signal import correlate
+from scipy.fft import rfft, irfft, next_fast_len
 import numpy as np
 import random
+import tempfile
+import functools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import cache
 
 
-def extract_beats_from_song(song_file):
-    """ Extract beats from original and return sequence for reference use """
-    # y: load audio as waveform (1-D numpy float array)
-    # sr: store Sampling Rate (default mono resampled at 22050Hz)
-    y, sr = librosa.load(song_file, sr=None)
-    _, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    # convert frame numbers (beat_frames) into timings
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr)
-    beat_sequence = [{"id": f"beat{i+1}", "time": beat_time} for i, beat_time in enumerate(beat_times)]
+ANALYSIS_SR = 22050  # fixed analysis rate of beat tracking and alignment
+ANALYSIS_HOP = 512
 
-    return beat_sequence
+# beats       : [{"id": "beat1", "time": seconds}, ...] as returned by extract_beats_from_song
+# tempo       : estimated tempo in beats per minute
+# envelope    : onset strength, one value per hop_length samples at sr
+BeatAnalysis = namedtuple("BeatAnalysis", ["beats", "tempo", "envelope", "sr", "hop_length"])
 
 
-def _extract_audio_from_video(video_file, output_audio):
-    """ Internal function to extract audio from video files to
-    compare with beat_sequence """
-    cmd = [
+def _audio_command(media_file, sr):
+    """ Internal function returning the ffmpeg command decoding the first audio stream
+    of a song or video as mono float32 at sampling rate sr to stdout, ffmpeg downmixes and resamples """
+    return [
         'ffmpeg',
-        '-i', video_file, # i: input
-        '-q:a', '0', #q:a set audio quality (0= best, 0=worst)
-        '-map', 'a', #map: select stream from input file (a=audio, v=video, s=subtitle, t=all data)
-        output_audio, #output filename
-        '-y', #enforce overwriting file
-        '-loglevel', 'error' # supress default message
+        '-i', media_file, # i: input
+        '-map', '0:a:0', # first audio stream only
+        '-ac', '1', # mono
+        '-ar', str(sr), # resample to the analysis rate
+        '-f', 'f32le', # raw 32 bit float samples
+        '-loglevel', 'error', # supress default message
+        'pipe:1' # write to stdout instead of a file
     ]
-    subprocess.run(cmd, check=True)
 
-    return output_audio
 
+def _audio_blocks(media_file, sr, block_samples=1 << 18):
+    """ Internal generator decoding audio in blocks of block_samples mono float32 samples """
+    process = subprocess.Popen(_audio_command(media_file, sr), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(block_samples * 4)
+            if not data:
+                break
+            yield np.frombuffer(data, dtype=np.float32)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"FFmpeg failed: {stderr.decode('utf-8')}")
+
+
+def _song_samples_file(song_hash, sr):
+    """ Internal function returning the cache entry file of the decoded song, raw mono float32 samples """
+    return cache.entry_file("audio", cache.cache_key(song_hash, "mono", sr), ".f32")
+
+
+def _saved_blocks(blocks, path):
+    """ Internal generator passing audio blocks through while appending them to the entry file path,
+    which only appears once every block is written. Nothing but the current block is held in memory """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            for block in blocks:
+                block.tofile(f)
+                yield block
+        os.replace(temp_path, path)
+        cache.evict(keep=(path,))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _streaming_onset_envelopes(blocks, sr, hop_length=512, n_fft=2048, n_mels=128, top_db=80.0):
+    """ Internal function computing librosa.onset.onset_strength of a stream of audio blocks,
+    aggregated over the mel bands by mean (onset_strength default) and by median (what
+    librosa.beat.beat_track uses). Only the log-mel frames are kept (a quarter of the samples
+    at hop 512), the waveform never is. returns (mean envelope, median envelope) """
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+    # center=True: the first frame is centered on sample 0 of a zero-padded signal
+    pending = np.zeros(n_fft // 2, dtype=np.float32)
+    samples = 0
+    mel_frames = []
+
+    def frames(signal):
+        spectrum = librosa.stft(signal, n_fft=n_fft, hop_length=hop_length, center=False)
+        return librosa.power_to_db(mel_basis @ np.abs(spectrum) ** 2, top_db=None).astype(np.float32)
+
+    for block in blocks:
+        samples += len(block)
+        pending = np.concatenate([pending, block])
+        if len(pending) >= n_fft:
+            count = 1 + (len(pending) - n_fft) // hop_length
+            mel_frames.append(frames(pending[:n_fft + (count - 1) * hop_length]))
+            pending = pending[count * hop_length:]
+    # center=True yields 1 + samples // hop_length frames, the last ones reach into the zero padding
+    remaining = 1 + samples // hop_length - sum(frame.shape[1] for frame in mel_frames)
+    if remaining > 0:
+        pending = np.concatenate([pending, np.zeros(n_fft + (remaining - 1) * hop_length - len(pending),
+                                                    dtype=np.float32)])
+        mel_frames.append(frames(pending))
+
+    mel_db = np.concatenate(mel_frames, axis=1)
+    np.maximum(mel_db, mel_db.max() - top_db, out=mel_db)  # power_to_db top_db, relative to the loudest bin
+    # positive difference to the previous frame, shifted like onset_strength (lag 1, centered frames)
+    onsets = np.maximum(0.0, mel_db[:, 1:] - mel_db[:, :-1])
+    padding = (1 + n_fft // (2 * hop_length), 0)
+    return tuple(np.pad(envelope, padding)[:mel_db.shape[1]]
+                 for envelope in (onsets.mean(axis=0), np.median(onsets, axis=0)))
+
+
+def analyze_song(song_file, sr=ANALYSIS_SR, hop_length=ANALYSIS_HOP):
+    """ Beats, tempo and onset envelope of a song, decoded in blocks at the fixed rate sr.
+    The envelope is computed once and shared by beat tracking and alignment,
+    the decoded samples are written to the cache block by block for the fine alignment pass,
+    so it does not decode the song again.
+    returns a BeatAnalysis, cached by file content """
+    song_hash = cache.file_hash(song_file)
+    key = cache.cache_key(song_hash, "analysis", sr, hop_length)
+    analysis = cache.load("beats", key)
+    if analysis is not None:
+        return analysis
+    # the samples are written to the entry _decode_song reads
+    blocks = _saved_blocks(_audio_blocks(song_file, sr), _song_samples_file(song_hash, sr))
+    envelope, beat_envelope = _streaming_onset_envelopes(blocks, sr, hop_length)
+    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=beat_envelope, sr=sr, hop_length=hop_length)
+    # convert frame numbers (beat_frames) into timings
+    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length)
+    beat_sequence = [{"id": f"beat{i+1}", "time": beat_time} for i, beat_time in enumerate(beat_times)]
+
+    return cache.store("beats", key, BeatAnalysis(beat_sequence, float(np.atleast_1d(tempo)[0]), envelope,
+                                                  sr, hop_length))
+
+
+def extract_beats_from_song(song_file):
+    """ Extract beats from original and return sequence for reference use """
+    return analyze_song(song_file).beats
+
+
+def _load_audio_from_video(video_file, sr):
+    """ Internal function to decode the audio of a video straight into memory
+    as mono float32 at sampling rate sr, ffmpeg downmixes and resamples """
+    result = subprocess.run(_audio_command(video_file, sr), check=True, capture_output=True)
+
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def _onset_envelope(y, sr, hop_length=512):
+    """ Internal function returning a zero-mean onset strength envelope,
+    used as a cheap stand-in for the waveform in the coarse alignment search """
+    envelope = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+    return envelope - envelope.mean()
+
+
+def _correlate_lags(signal, reference, min_lag, max_lag, spectrum=None):
+    """ Internal function to correlate signal[n + lag] with reference[n] via FFT
+    for every lag in [min_lag, max_lag] only, so memory stays close to len(reference).
+    spectrum : optional (nfft, spectrum) of reference from _reference_spectrum, reused for many lag ranges
+    returns the correlation values, index j belongs to lag min_lag + j """
+    # zero-padded view of signal covering every requested lag
+    segment = np.zeros(max_lag - min_lag + len(reference), dtype=np.float32)
+    src_start = max(min_lag, 0)
+    src_end = min(max_lag + len(reference), len(signal))
+    if src_end > src_start:
+        segment[src_start - min_lag:src_end - min_lag] = signal[src_start:src_end]
+    if spectrum is None:
+        return correlate(segment, reference, mode='valid', method='fft')
+    nfft, reference_spectrum = spectrum
+    return irfft(rfft(segment, nfft) * reference_spectrum, nfft)[:max_lag - min_lag + 1]
+
+
+def _reference_spectrum(reference, max_lags):
+    """ Internal function transforming reference once for _correlate_lags over at most max_lags lags """
+    nfft = next_fast_len(len(reference) + max_lags - 1, real=True)
+    return nfft, np.conj(rfft(reference, nfft))
 
-def _align_song_to_video(song_file, video_audio):
+
+def _estimate_lag(song, video, sr, max_lag=None, hop_length=512, refine_hops=4, margin=0.4, song_envelope=None):
+    """ Internal function to estimate the lag (in samples) of song inside video,
+    the lag of the maximum of the full waveform cross-correlation.
+    coarse    : correlate onset envelopes (one value per hop) over all allowed lags,
+                averaged over the overlapping frames so lags with more overlap do not win
+    fine      : correlate the waveforms only within refine_hops hops of the coarse peaks
+    margin    : every coarse peak within margin * (best - median) of the best one is refined,
+                repetitive songs have a peak on every beat and only the waveform tells them apart
+    max_lag   : optional bound in samples on how far the search looks in either direction
+    song_envelope : onset strength of song at sr and hop_length if already known, e.g. from analyze_song """
+    if song_envelope is None:
+        song_envelope = _onset_envelope(song, sr, hop_length)
+    else:
+        song_envelope = song_envelope - song_envelope.mean()
+    video_envelope = _onset_envelope(video, sr, hop_length)
+
+    # coarse search over the downsampled envelope
+    min_coarse = -(len(song_envelope) - 1)
+    max_coarse = len(video_envelope) - 1
+    if max_lag is not None:
+        bound = int(np.ceil(max_lag / hop_length))
+        min_coarse, max_coarse = max(min_coarse, -bound), max(min(max_coarse, bound), min_coarse)
+    coarse = _correlate_lags(video_envelope, song_envelope, min_coarse, max_coarse)
+    lags = np.arange(min_coarse, max_coarse + 1)
+    overlap = np.minimum(len(video_envelope), lags + len(song_envelope)) - np.maximum(lags, 0)
+    # averages over short overlaps at the edges are noisy, count at least half of the shorter envelope
+    coarse = coarse / np.maximum(overlap, max(1, min(len(song_envelope), len(video_envelope)) // 2))
+    threshold = coarse.max() - margin * (coarse.max() - np.median(coarse))
+
+    # windows at full sampling rate around every well separated coarse peak above the threshold
+    windows = []
+    for index in np.argsort(coarse)[::-1]:
+        if coarse[index] == -np.inf:
+            continue  # next to a peak already taken
+        if coarse[index] < threshold:
+            break
+        coarse_lag = (min_coarse + int(index)) * hop_length
+        coarse[max(index - 2 * refine_hops, 0):index + 2 * refine_hops + 1] = -np.inf
+
+        min_lag = max(coarse_lag - refine_hops * hop_length, -(len(song) - 1))
+        max_fine = min(coarse_lag + refine_hops * hop_length, len(video) - 1)
+        if max_lag is not None:
+            min_lag, max_fine = max(min_lag, -max_lag), min(max_fine, max_lag)
+        windows.append((min_lag, max(min_lag, max_fine)))
+
+    window_lags = 2 * refine_hops * hop_length + 1
+    first_lag = min(start for start, _ in windows)
+    last_lag = max(end for _, end in windows)
+    if len(windows) * (len(song) + window_lags) > len(song) + last_lag - first_lag:
+        # many peaks (a steady beat repeats on every beat): one correlation over the lags
+        # spanning all of them is cheaper than one per window
+        fine = _correlate_lags(video, song, first_lag, last_lag)
+        return first_lag + int(np.argmax(fine))
+
+    spectrum = _reference_spectrum(song, window_lags)
+    best_lag, best_score = 0, -np.inf
+    for min_lag, max_fine in windows:
+        fine = _correlate_lags(video, song, min_lag, max_fine, spectrum)
+        if fine.max() > best_score:
+            best_lag, best_score = min_lag + int(np.argmax(fine)), fine.max()
+
+    return best_lag
+
+
+def _align_song_to_video(song, video, sr, max_offset=None, song_envelope=None):
     """ Internal function to align the beats from the original song
-    with the video audio using cross-correlation. """
-    song, sr_song = librosa.load(song_file, sr=None)
-    video, sr_video = librosa.load(video_audio, sr=None)
-    # ensure consistent sampling rate
-    if sr_song != sr_video:
-        video = librosa.resample(video, orig_sr=sr_video, target_sr=sr_song)
-    # correlate original-audio with video-audio to find similarity
-    correlation = correlate(video, song, mode='full')
-    # contains all possible shifts from correlation => find maximum
-    lag = np.argmax(correlation) - len(song)
+    with the video audio using coarse-to-fine FFT cross-correlation.
+    song, video: mono waveforms at the same sampling rate sr
+    max_offset : optional bound in seconds on the offset search
+    song_envelope : optional onset envelope of the song (hop 512), skips computing it again """
+    max_lag = None if max_offset is None else int(max_offset * sr)
+    # lag in samples at which the song starts inside the video-audio
+    lag = _estimate_lag(song, video, sr, max_lag=max_lag, song_envelope=song_envelope)
     # divide lag by sampling rate to get offset in seconds
-    offset_time = lag / sr_song
+    offset_time = lag / sr
     print(f"Offset between song and video: {offset_time:.2f} seconds") # debug
 
     return offset_time
 
 
+_song_lock = threading.Lock()
 
-def cut_videos_by_song_beats(video_folder, beat_sequence, song_file, output_dir):
-    """Cut videos based on beat sequence with slight adjustment to reduce lag."""
-    os.makedirs(output_dir, exist_ok=True)
-    video_files = [
+
+@functools.lru_cache(maxsize=1)
+def _decode_song(song_hash, song_file):
+    """ Internal function returning the song at the analysis rate, the samples analyze_song decoded
+    and saved. Only decoded again when that entry was evicted.
+    Kept in memory so all takes of a run share one copy """
+    path = _song_samples_file(song_hash, ANALYSIS_SR)
+    try:
+        waveform = np.fromfile(path, dtype=np.float32)
+    except FileNotFoundError:
+        waveform = np.concatenate(list(_saved_blocks(_audio_blocks(song_file, ANALYSIS_SR), path)))
+    try:
+        os.utime(path)  # mark as recently used for eviction
+    except OSError:
+        pass  # evicted by another thread after reading, the samples are still valid
+    return waveform, ANALYSIS_SR
+
+
+def _song_audio(song_file):
+    """ Internal function returning (waveform, sr) of the song, decoded once per run.
+    The lock keeps takes aligned in parallel from all decoding the song on the first miss """
+    song_hash = cache.file_hash(song_file)
+    with _song_lock:
+        return _decode_song(song_hash, song_file)
+
+
+def _take_audio(video_file, sr):
+    """ Internal function to decode the audio of a take at sampling rate sr, cached """
+    key = cache.cache_key(cache.file_hash(video_file), "mono", sr)
+    video = cache.load("audio", key)
+    if video is None:
+        video = cache.store("audio", key, _load_audio_from_video(video_file, sr))
+    return video
+
+
+def _video_fps(video_file):
+    """ Internal function to read the average frame rate of the first video stream """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=avg_frame_rate',
+        '-of', 'csv=p=0',
+        video_file
+    ]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    numerator, _, denominator = result.stdout.strip().partition('/')
+    return float(numerator) / float(denominator or 1)
+
+
+def _video_duration(video_file):
+    """ Internal function to read the duration of the first video stream in seconds,
+    the container duration if the stream does not report one """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=duration:format=duration',
+        '-of', 'csv=p=0',
+        video_file
+    ]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    for value in result.stdout.split():
+        try:
+            return float(value.strip(','))
+        except ValueError:
+            continue  # N/A
+    raise RuntimeError(f"Cannot read the duration of {video_file}")
+
+
+def _take_duration(video_file):
+    """ Internal function returning the duration of a take, probed once and cached """
+    key = cache.cache_key(cache.file_hash(video_file), "duration")
+    duration = cache.load("offsets", key)
+    if duration is None:
+        duration = cache.store("offsets", key, _video_duration(video_file))
+    return duration
+
+
+def _thread_args(threads):
+    """ Internal function returning the ffmpeg thread limit arguments, if any.
+    Before an -i they limit the decoder of that input, before the output file the encoder """
+    return ['-threads', str(threads)] if threads else []
+
+
+def _split_threads(max_threads, stages):
+    """ Internal function splitting one thread budget over the stages of an ffmpeg process
+    running at the same time (decoders, filtergraph, encoder), the remainder goes to the last ones.
+    Every stage gets at least one thread, so with more stages than max_threads the sum exceeds it.
+    returns one thread count per stage, all None without a budget (ffmpeg default) """
+    if not max_threads:
+        return [None] * stages
+    base, extra = divmod(max_threads, stages)
+    return [max(1, base + (stage >= stages - extra)) for stage in range(stages)]
+
+
+def _beat_windows(beat_sequence, offset, micro_trim, duration=None):
+    """ Internal function returning (beat_id, start, end) in take time for
+    every beat the take covers, with micro_trim taken off the end.
+    duration : length of the take in seconds, beats the take ends in are left out,
+               a shorter cut would make every later cut run early against the song.
+               Only the last beat is cut short at the end of the take """
+    windows = []
+    for i, beat in enumerate(beat_sequence):
+        beat_start = beat["time"] + offset
+        if i + 1 < len(beat_sequence):
+            beat_end = beat_sequence[i + 1]["time"] + offset
+        else:
+            beat_end = beat_start + 9.5  # Default for last beat
+        adjusted_beat_end = max(beat_end - micro_trim, beat_start)
+        if beat_start < 0:
+            continue
+        if duration is not None:
+            if beat_start >= duration:
+                continue
+            if adjusted_beat_end > duration:
+                if i + 1 < len(beat_sequence):
+                    continue
+                adjusted_beat_end = duration
+        windows.append((beat["id"], beat_start, adjusted_beat_end))
+
+    return windows
+
+
+def _cut_take_per_beat(video_file, video_index, windows, output_dir, threads=None):
+    """ Internal function to cut one take with one ffmpeg process per beat,
+    threads is shared by the decoder and the encoder """
+    decoder_threads, encoder_threads = _split_threads(threads, 2)
+    clips = {}
+    for beat_id, beat_start, beat_end in windows:
+        output_file = os.path.join(output_dir, f"{beat_id}_video{video_index}.mp4")
+        cmd = [
+            'ffmpeg',
+            '-accurate_seek',
+            '-ss', f"{beat_start:.6f}",
+            *_thread_args(decoder_threads),
+            '-i', video_file,
+            '-to', f"{beat_end - beat_start:.6f}",
+            '-c:v', 'libx264',
+            '-preset', 'ultrafast',
+            '-c:a', 'aac',
+            *_thread_args(encoder_threads),
+            '-loglevel', 'quiet',
+            output_file
+        ]
+        subprocess.run(cmd, check=True)
+        clips[beat_id] = output_file
+
+    return clips
+
+
+def _cut_take_single_pass(video_file, video_index, windows, output_dir, threads=None):
+    """ Internal function to cut one take at all beat boundaries in a single decode pass.
+    Keyframes are forced at every cut and the segment muxer splits on them, the gaps
+    left by micro_trim become segments of their own and are deleted afterwards.
+    threads is shared by the decoder and the encoder """
+    decoder_threads, encoder_threads = _split_threads(threads, 2)
+    fps = _video_fps(video_file)
+    # snap cuts to frames so no two cuts ever land on the same frame
+    beat_frames = [(beat_id, round(start * fps), round(end * fps)) for beat_id, start, end in windows]
+    beat_frames = [(beat_id, start, end) for beat_id, start, end in beat_frames if end > start]
+    cut_frames = sorted({frame for _, start, end in beat_frames for frame in (start, end) if frame > 0})
+    if not cut_frames:
+        return {}
+    # half a frame early, so the first frame at or after the cut time is the cut frame
+    cut_times = ','.join(f"{(frame - 0.5) / fps:.6f}" for frame in cut_frames)
+
+    segment_pattern = os.path.join(output_dir, f"video{video_index}_segment%05d.mp4")
+    cmd = [
+        'ffmpeg',
+        *_thread_args(decoder_threads),
+        '-i', video_file,
+        '-map', '0:v:0',
+        '-map', '0:a?',
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-force_key_frames', cut_times,
+        '-c:a', 'aac',
+        '-f', 'segment',
+        '-segment_times', cut_times,
+        '-reset_timestamps', '1',
+        *_thread_args(encoder_threads),
+        '-loglevel', 'error',
+        '-y',
+        segment_pattern
+    ]
+    subprocess.run(cmd, check=True)
+
+    # segment k starts at segment_starts[k]
+    segment_starts = [0] + cut_frames
+    clips = {}
+    for beat_id, start, _ in beat_frames:
+        segment_file = segment_pattern % segment_starts.index(start)
+        if not os.path.exists(segment_file):
+            continue  # beat lies beyond the end of the take
+        output_file = os.path.join(output_dir, f"{beat_id}_video{video_index}.mp4")
+        os.replace(segment_file, output_file)
+        clips[beat_id] = output_file
+    # remove leading segment and micro_trim gaps
+    for segment_index in range(len(segment_starts)):
+        if os.path.exists(segment_pattern % segment_index):
+            os.remove(segment_pattern % segment_index)
+
+    return clips
+
+
+def _list_video_files(video_folder):
+    """ Internal function returning the takes of a folder in a stable order """
+    return sorted(
         os.path.join(video_folder, f)
         for f in os.listdir(video_folder)
         if f.endswith(('.mp4', '.MP4', '.mov', '.MOV', '.avi', '.AVI', '.mkv', '.MKV'))
-    ]
+    )
+
+
+def _micro_trim(beat_sequence, total_lag=2.0):
+    """ Internal function spreading the observed total lag over all beats """
+    # total_lag: adjust this based on observed lag
+    return total_lag / len(beat_sequence)
+
+
+def _take_offset(video_file, song_file, max_offset):
+    """ Internal function to decode the audio of a take and align it with the song, cached """
+    key = cache.cache_key(cache.file_hash(song_file), cache.file_hash(video_file), max_offset, ANALYSIS_SR)
+    offset = cache.load("offsets", key)
+    if offset is None:
+        song, sr = _song_audio(song_file)
+        video = _take_audio(video_file, sr)
+        # the coarse search reuses the onset envelope of the beat analysis
+        offset = cache.store("offsets", key, _align_song_to_video(song, video, sr, max_offset,
+                                                                  analyze_song(song_file).envelope))
+    return offset
+
+
+def _cut_take(video_file, video_index, beat_sequence, song_file, output_dir, micro_trim, max_offset, mode, threads):
+    """ Internal function to extract, align and cut a single take """
+    offset = _take_offset(video_file, song_file, max_offset)
+
+    windows = _beat_windows(beat_sequence, offset, micro_trim, _take_duration(video_file))
+    # clips of an earlier run with the same take and beats can be reused as long as they are the files
+    # it wrote, a run with other windows writes other clips to the same paths
+    key = cache.cache_key(cache.file_hash(video_file), video_index, windows, mode, os.path.abspath(output_dir),
+                          "fingerprints")
+    entry = cache.load("clips", key)
+    if entry is not None:
+        clips, fingerprints = entry
+        if all(_clip_fingerprint(clip) == fingerprints[clip] for clip in clips.values()):
+            return clips
+    cut_take = _cut_take_single_pass if mode == "single_pass" else _cut_take_per_beat
+    clips = cut_take(video_file, video_index, windows, output_dir, threads)
+    cache.store("clips", key, (clips, {clip: _clip_fingerprint(clip) for clip in clips.values()}))
+    return clips
+
+
+def _clip_fingerprint(clip):
+    """ Internal function returning (size, mtime in ns) of a clip file, None if it does not exist """
+    try:
+        stat = os.stat(clip)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def cut_videos_by_song_beats(video_folder, beat_sequence, song_file, output_dir, max_offset=None, mode="per_beat",
+                             workers=1, max_ffmpeg_threads=None):
+    """Cut videos based on beat sequence with slight adjustment to reduce lag.
+        max_offset         : optional bound in seconds on how far takes are searched for the song
+        mode               : per_beat (one ffmpeg per clip) or single_pass (one ffmpeg per take)
+        workers            : number of takes processed at the same time
+        max_ffmpeg_threads : cap on ffmpeg threads summed over all workers, decoders and encoders included,
+                             None = ffmpeg default. Bounds workers to max_ffmpeg_threads // 2"""
+    os.makedirs(output_dir, exist_ok=True)
+    video_files = _list_video_files(video_folder)
     print("Detected video files:", video_files)  # Debugging
 
     if not video_files:
         print("Error: No video files found in the folder.")
         return
+    if mode not in ("per_beat", "single_pass"):
+        raise ValueError(f"Unknown cutting mode: {mode}")
     clips_by_beat = {beat["id"]: [] for beat in beat_sequence}
 
-    total_lag = 2.0  # Adjust this based on observed lag
-    micro_trim = total_lag / len(beat_sequence)
-
-    for video_index, video_file in enumerate(video_files, start=1):
-        audio_output = os.path.join(output_dir, f"video{video_index}.wav")
-        _extract_audio_from_video(video_file, audio_output)
-        offset = _align_song_to_video(song_file, audio_output)
-
-        for i, beat in enumerate(beat_sequence):
-            beat_start = beat["time"] + offset
-            if i + 1 < len(beat_sequence):
-                beat_end = beat_sequence[i + 1]["time"] + offset
-            else:
-                beat_end = beat_start + 9.5  # Default for last beat
-            adjusted_beat_end = max(beat_end - micro_trim, beat_start)
-            if beat_start < 0:
+    micro_trim = _micro_trim(beat_sequence)
+
+    workers = max(1, min(workers, len(video_files)))
+    if max_ffmpeg_threads:
+        workers = max(1, min(workers, max_ffmpeg_threads // 2))  # a decoder and an encoder thread each
+    threads = max_ffmpeg_threads // workers if max_ffmpeg_threads else None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_cut_take, video_file, video_index, beat_sequence, song_file, output_dir,
+                        micro_trim, max_offset, mode, threads)
+            for video_index, video_file in enumerate(video_files, start=1)
+        ]
+        # collect in video_index order so clips_by_beat does not depend on scheduling
+        for video_file, future in zip(video_files, futures):
+            try:
+                clips = future.result()
+            except Exception as e:
+                print(f"Error: skipping take {video_file}: {e}")
                 continue
-            output_file = os.path.join(
-                output_dir, f"{beat['id']}_video{video_index}.mp4"
-            )
-            cmd = [
-                'ffmpeg',
-                '-accurate_seek',
-                '-ss', f"{beat_start:.6f}",
-                '-i', video_file,
-                '-to', f"{adjusted_beat_end - beat_start:.6f}",
-                '-c:v', 'libx264',
-                '-preset', 'ultrafast',
-                '-c:a', 'aac',
-                '-loglevel', 'quiet',
-                output_file
-            ]
-            subprocess.run(cmd, check=True)
-            clips_by_beat[beat["id"]].append(output_file)
+            for beat_id, output_file in clips.items():
+                clips_by_beat[beat_id].append(output_file)
 
     return clips_by_beat
 
 
-def concatenate_clips_randomly(clips_by_beat, beat_sequence, output_file, song_file):
-    """ Concatenate random video clips according to beat_sequence"""
-    concat_file = os.path.join(os.path.dirname(output_file), "concat_list.txt")
+def _align_take(video_file, song_file, max_offset):
+    """ Internal function aligning a take and probing its duration for plan_edit_decision_list """
+    _take_duration(video_file)
+    return _take_offset(video_file, song_file, max_offset)
+
+
+def align_takes(video_folder, song_file, max_offset=None, workers=1):
+    """ Align every take in video_folder with the song without cutting anything.
+    The duration of every take is probed and cached along the way.
+        returns {video_file: offset in seconds} in video_index order, failing takes are left out """
+    video_files = _list_video_files(video_folder)
+    print("Detected video files:", video_files)  # Debugging
+
+    take_offsets = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(video_files) or 1))) as pool:
+        futures = [
+            pool.submit(_align_take, video_file, song_file, max_offset)
+            for video_file in video_files
+        ]
+        for video_file, future in zip(video_files, futures):
+            try:
+                take_offsets[video_file] = future.result()
+            except Exception as e:
+                print(f"Error: skipping take {video_file}: {e}")
+
+    return take_offsets
+
+
+def plan_edit_decision_list(beat_sequence, take_offsets, seed=None):
+    """ Build an edit decision list: for every beat a random take that covers the whole beat.
+        take_offsets : {video_file: offset} as returned by align_takes, take durations are probed there
+        seed         : optional seed to reproduce a cut
+        returns [{"beat": id, "take": video_file, "start": s, "end": e}] in song order,
+        start and end in seconds of the take """
+    rng = random.Random(seed)
+    micro_trim = _micro_trim(beat_sequence)
+    windows_by_beat = {beat["id"]: [] for beat in beat_sequence}
+    for video_file, offset in take_offsets.items():
+        for beat_id, beat_start, beat_end in _beat_windows(beat_sequence, offset, micro_trim,
+                                                           _take_duration(video_file)):
+            windows_by_beat[beat_id].append((video_file, beat_start, beat_end))
+
+    edit_decision_list = []
+    for beat in beat_sequence:
+        if windows_by_beat[beat["id"]]:
+            # for every beat in sequence chose a random take
+            video_file, beat_start, beat_end = rng.choice(windows_by_beat[beat["id"]])
+            edit_decision_list.append({"beat": beat["id"], "take": video_file, "start": beat_start, "end": beat_end})
+
+    return edit_decision_list
+
+
+def _edit_filtergraph(edit_decision_list, takes):
+    """ Internal function building a trim/concat filtergraph over the takes.
+    Every take is decoded once and split into one trim per entry that uses it """
+    entries_by_take = {video_file: [] for video_file in takes}
+    for entry_index, entry in enumerate(edit_decision_list):
+        entries_by_take[entry["take"]].append((entry_index, entry))
+
+    chains = []
+    for input_index, video_file in enumerate(takes):
+        entries = entries_by_take[video_file]
+        split_outputs = ''.join(f"[t{input_index}_{n}]" for n in range(len(entries)))
+        chains.append(f"[{input_index}:v:0]split={len(entries)}{split_outputs}")
+        for n, (entry_index, entry) in enumerate(entries):
+            chains.append(
+                f"[t{input_index}_{n}]trim=start={entry['start']:.6f}:end={entry['end']:.6f},"
+                f"setpts=PTS-STARTPTS[v{entry_index}]"
+            )
+    concat_inputs = ''.join(f"[v{entry_index}]" for entry_index in range(len(edit_decision_list)))
+    chains.append(f"{concat_inputs}concat=n={len(edit_decision_list)}:v=1:a=0[outv]")
+
+    return ';\n'.join(chains)
+
+
+def _render_filtergraph(edit_decision_list, song_file, output_file, max_ffmpeg_threads=None):
+    """ Internal function to render the edit decision list in one ffmpeg pass:
+    decode each take once, trim and concat in a filtergraph, encode once and
+    mux the song audio in the same pass. No intermediate clips are written """
+    takes = sorted({entry["take"] for entry in edit_decision_list})
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # the graph grows with the number of beats, pass it as a file instead of an argument
+        filter_script = os.path.join(temp_dir, "edit_filtergraph.txt")
+        with open(filter_script, 'w') as f:
+            f.write(_edit_filtergraph(edit_decision_list, takes))
+        # all takes are decoded at the same time as the filtergraph and the encoder run, they share the limit
+        *decoder_threads, filter_threads, encoder_threads = _split_threads(max_ffmpeg_threads, len(takes) + 2)
+        cmd = ['ffmpeg']
+        for video_file, threads in zip(takes, decoder_threads):
+            cmd += [*_thread_args(threads), '-i', video_file]
+        if filter_threads:
+            cmd += ['-filter_complex_threads', str(filter_threads)]
+        cmd += [
+            '-i', song_file,
+            '-filter_complex_script', filter_script,
+            '-map', '[outv]',  # trimmed and joined takes
+            '-map', f'{len(takes)}:a:0',  # last input: song audio
+            '-fps_mode', 'passthrough',  # keep the trimmed timestamps, no frame dropping to a default rate
+            '-c:v', 'libx264',
+            '-preset', 'ultrafast',
+            '-c:a', 'aac',
+            *_thread_args(encoder_threads),
+            '-loglevel', 'error',
+            '-y',
+            output_file
+        ]
+        subprocess.run(cmd, check=True)
+    print(f"Created final video: {output_file}")
+
+
+def render_edit_decision_list(edit_decision_list, song_file, output_file, clips_dir=None, max_ffmpeg_threads=None,
+                              method="filtergraph"):
+    """ Render the final video straight from the source takes.
+        method    : filtergraph (one decode and one encode, no intermediate files)
+                    or clips (cut only the chosen clips, then concatenate them)
+        clips_dir : clips method only, keep the cut clips here, None = temporary directory removed afterwards """
+    if not edit_decision_list:
+        print("Error: Edit decision list is empty, nothing to render.")
+        return
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    if method == "filtergraph":
+        _render_filtergraph(edit_decision_list, song_file, output_file, max_ffmpeg_threads)
+        return
+    if method != "clips":
+        raise ValueError(f"Unknown render method: {method}")
+
+    takes = sorted({entry["take"] for entry in edit_decision_list})
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = clips_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        clip_by_beat = {}
+        for video_index, video_file in enumerate(takes, start=1):
+            windows = [(entry["beat"], entry["start"], entry["end"])
+                       for entry in edit_decision_list if entry["take"] == video_file]
+            clip_by_beat.update(_cut_take_per_beat(video_file, video_index, windows, work_dir, max_ffmpeg_threads))
+        clips = [clip_by_beat[entry["beat"]] for entry in edit_decision_list]
+        _concatenate_clips(clips, song_file, output_file, os.path.join(work_dir, "concat_list.txt"))
+
+
+def _concatenate_clips(clips, song_file, output_file, concat_file):
+    """ Internal function to join clips in order and lay the song underneath """
     with open(concat_file, 'w') as f:
-        for beat in beat_sequence:
-            if clips_by_beat[beat['id']]:
-                # for every beat in sequence chose a random take
-                chosen_clip = random.choice(clips_by_beat[beat['id']])
-                clip_path = os.path.abspath(chosen_clip)
-                f.write(f"file '{clip_path}'\n")
+        for clip in clips:
+            clip_path = os.path.abspath(clip)
+            f.write(f"file '{clip_path}'\n")
     cmd = [
         'ffmpeg',
         '-f', 'concat', #specify format of input/output
@@ -138,4 +733,13 @@ def concatenate_clips_randomly(clips_by_beat, beat_sequence, output_file, song_f
     print(f"Created final video: {output_file}")
 
 
-
+def concatenate_clips_randomly(clips_by_beat, beat_sequence, output_file, song_file):
+    """ Concatenate random video clips according to beat_sequence"""
+    concat_file = os.path.join(os.path.dirname(output_file), "concat_list.txt")
+    clips = [
+        # for every beat in sequence chose a random take
+        random.choice(clips_by_beat[beat['id']])
+        for beat in beat_sequence
+        if clips_by_beat[beat['id']]
+    ]
+    _concatenate_clips(clips, song_file, output_file, concat_file)